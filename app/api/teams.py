@@ -1,12 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, File, Form, UploadFile
 from fastapi.security import OAuth2AuthorizationCodeBearer
 from services.graph_service import graph_service
+from services.jobs import job_store, job_queue
+from services.group_chats import describir_audiencia
+from services.directory import DirectoryAccessDenied
+from services.serialization import FastJSONResponse
 from pydantic import BaseModel
 import base64
+import io
 import httpx
-from typing import List
+from typing import List, Literal, Optional
 
-router = APIRouter()
+router = APIRouter(default_response_class=FastJSONResponse)
 
 oauth2_scheme = OAuth2AuthorizationCodeBearer(
     authorizationUrl="/auth/login",
@@ -39,33 +44,189 @@ async def send_message(
 
 
 
-class MessageWithAttachmentRequest(BaseModel):
-    id: List[str]          # Lista de user_ids
+class AudienceSelector(BaseModel):
+    id: Optional[List[str]] = None          # Lista de user_ids
+    carrera: Optional[str] = None           # letra de la matrícula (S, D, G, T, K) o nombre de la carrera
+    matricula_prefix: Optional[str] = None  # p.ej. "2021" para la generación 2021
+    delivery: Literal["oneOnOne", "group"] = "oneOnOne"  # "group": un solo mensaje en el chat grupal de la audiencia
+
+
+async def resolver_destinatarios(token: str, ids: Optional[List[str]], carrera: Optional[str], matricula_prefix: Optional[str]) -> List[str]:
+    """Ids explícitos más los alumnos seleccionados por carrera/generación en el directorio"""
+    if not ids and not carrera and not matricula_prefix:
+        raise HTTPException(status_code=422, detail="Indica los destinatarios (id) o un selector (carrera, matricula_prefix)")
+
+    try:
+        user_ids = await graph_service.resolve_audience(token, ids, carrera, matricula_prefix)
+    except DirectoryAccessDenied:
+        raise HTTPException(status_code=403, detail="Los selectores de audiencia solo están disponibles para cuentas de ITSA")
+    if not user_ids:
+        raise HTTPException(status_code=422, detail="Ningún alumno coincide con los selectores indicados")
+    return user_ids
+
+
+def chat_grupal(delivery: str, ids: Optional[List[str]], carrera: Optional[str], matricula_prefix: Optional[str]):
+    """(audience_key, topic) del chat grupal si se pidió delivery="group"; None para chats 1 a 1"""
+    if delivery == "oneOnOne":
+        return None
+    if delivery != "group":
+        raise HTTPException(status_code=422, detail='delivery debe ser "oneOnOne" o "group"')
+    return describir_audiencia(ids, carrera, matricula_prefix)
+
+
+class BulkMessageRequest(AudienceSelector):
+    message: str           # plantilla, p.ej. "Hola {displayName} ({matricula})"
+
+# Un mismo texto (personalizable por alumno) para muchos destinatarios en una sola petición
+@router.post("/send-bulk-message")
+async def send_bulk_message(
+    data: BulkMessageRequest,
+    token: str = Depends(oauth2_scheme),
+):
+    try:
+        user_ids = await resolver_destinatarios(token, data.id, data.carrera, data.matricula_prefix)
+        group = chat_grupal(data.delivery, data.id, data.carrera, data.matricula_prefix)
+        results = await graph_service.send_bulk_message(token, user_ids, data.message, group=group)
+        return resumen_de_envio(results)
+
+    except HTTPException:
+        raise
+    except DirectoryAccessDenied:
+        raise HTTPException(status_code=403, detail="Las plantillas con datos del directorio solo están disponibles para cuentas de ITSA")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+
+def resumen_de_envio(results: list):
+    """
+    "success" si llegó a todos, "partial" si falló alguno y "error" si no llegó a
+    nadie; en ese caso se responde 502 (como antes, un envío fallido no es un 200)
+    """
+    failed = sum(1 for r in results if r["status"] != "success")
+    sent = len(results) - failed
+
+    if failed == 0:
+        status = "success"
+    elif sent > 0:
+        status = "partial"
+    else:
+        status = "error"
+
+    resumen = {
+        "status": status,
+        "sent": sent,
+        "failed": failed,
+        "results": results
+    }
+    if status == "error":
+        return FastJSONResponse(resumen, status_code=502)
+    return resumen
+
+
+async def encolar_envio(token: str, user_ids: List[str], content: str, file_obj, file_size: int, file_name: str):
+    """Sube el archivo ahora y deja la entrega a los destinatarios a la cola de envíos"""
+    sender_id, message_body = await graph_service.prepare_message_with_file(
+        token, content, file_obj, file_size, file_name
+    )
+    job_id = job_store.create(sender_id, token, message_body, user_ids)
+    job_queue.enqueue(job_id)
+
+    return {
+        "status": "queued",
+        "job_id": job_id,
+        "total": len(user_ids)
+    }
+
+
+class MessageWithAttachmentRequest(AudienceSelector):
     message: str
     file: str              # archivo en base64
     file_name: str         # nombre original del archivo
 
+# Con background=true responde de inmediato con un job_id y el envío sigue en la cola.
+# Con delivery="group" el envío son pocas peticiones y se hace siempre en el momento.
 @router.post("/send-message-with-attachment")
 async def send_message_with_attachment(
     data: MessageWithAttachmentRequest,
+    background: bool = False,
     token: str = Depends(oauth2_scheme),
 ):
     try:
+        user_ids = await resolver_destinatarios(token, data.id, data.carrera, data.matricula_prefix)
+        group = chat_grupal(data.delivery, data.id, data.carrera, data.matricula_prefix)
         file_bytes = base64.b64decode(data.file)
 
+        if background and group is None:
+            return await encolar_envio(token, user_ids, data.message, io.BytesIO(file_bytes), len(file_bytes), data.file_name)
+
         results = await graph_service.send_message_with_attachment(
             token=token,
-            user_ids=data.id,
+            user_ids=user_ids,
             content=data.message,
             file_bytes=file_bytes,
-            file_name=data.file_name
+            file_name=data.file_name,
+            group=group
+        )
+
+        return resumen_de_envio(results)
+
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(
+            status_code=e.response.status_code,
+            detail=f"Graph API error: {e.response.text}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+
+# Variante multipart/form-data: el archivo llega como parte binaria (sin base64),
+# Starlette lo guarda en un temporal y se sube a OneDrive por fragmentos desde ahí
+@router.post("/send-message-with-attachment/upload")
+async def send_message_with_attachment_upload(
+    message: str = Form(...),
+    file: UploadFile = File(...),
+    id: Optional[List[str]] = Form(None),
+    carrera: Optional[str] = Form(None),
+    matricula_prefix: Optional[str] = Form(None),
+    delivery: str = Form("oneOnOne"),
+    background: bool = False,
+    token: str = Depends(oauth2_scheme),
+):
+    try:
+        user_ids = await resolver_destinatarios(token, id, carrera, matricula_prefix)
+        group = chat_grupal(delivery, id, carrera, matricula_prefix)
+
+        file.file.seek(0, 2)
+        file_size = file.file.tell()
+        file.file.seek(0)
+
+        if background and group is None:
+            return await encolar_envio(token, user_ids, message, file.file, file_size, file.filename)
+
+        results = await graph_service.send_message_with_file(
+            token=token,
+            user_ids=user_ids,
+            content=message,
+            file_obj=file.file,
+            file_size=file_size,
+            file_name=file.filename,
+            group=group
         )
 
-        return {
-            "status": "success",
-            "results": results
-        }
+        return resumen_de_envio(results)
 
+    except HTTPException:
+        raise
     except httpx.HTTPStatusError as e:
         raise HTTPException(
             status_code=e.response.status_code,
@@ -75,4 +236,41 @@ async def send_message_with_attachment(
         raise HTTPException(
             status_code=500,
             detail=f"Internal server error: {str(e)}"
-        )
\ No newline at end of file
+        )
+    finally:
+        await file.close()
+
+
+async def obtener_job(job_id: str, token: str):
+    """Devuelve el envío solo si pertenece a quien hace la petición"""
+    job = job_store.get(job_id)
+    if job is None or (await graph_service.get_me(token))["id"] != job["sender_id"]:
+        raise HTTPException(status_code=404, detail="Envío no encontrado")
+    return job
+
+
+# Progreso de un envío en segundo plano
+@router.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, token: str = Depends(oauth2_scheme)):
+    job = await obtener_job(job_id, token)
+
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "error": job["error"],
+        **job_store.progress(job_id),
+        "failures": job_store.failures(job_id)
+    }
+
+
+# Reanuda un envío pausado (p.ej. porque venció el token) con el token actual
+@router.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str, token: str = Depends(oauth2_scheme)):
+    await obtener_job(job_id, token)
+    # Solo los pausados o fallidos: uno en cola o en curso se enviaría dos veces
+    if not job_store.requeue(job_id, token):
+        raise HTTPException(status_code=409, detail="Solo se puede reanudar un envío pausado o fallido")
+
+    job_queue.enqueue(job_id)
+
+    return {"job_id": job_id, "status": "queued", **job_store.progress(job_id)}
\ No newline at end of file
@@ -1,9 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2AuthorizationCodeBearer
 from services.graph_service import graph_service
+from services.directory import DirectoryAccessDenied
+from services.serialization import FastJSONResponse, dumps
+import hashlib
 
 
-router = APIRouter()
+router = APIRouter(default_response_class=FastJSONResponse)
 
 oauth2_scheme = OAuth2AuthorizationCodeBearer(
     authorizationUrl="/auth/login",
@@ -11,12 +16,99 @@ oauth2_scheme = OAuth2AuthorizationCodeBearer(
 )
 
 # ✅ Obtener todos los usuarios del tenant
+# Sin parámetros devuelve la lista completa; con filtros usa los índices del directorio
 @router.get("/all")
-async def get_all_users(token: str = Depends(oauth2_scheme)):
+async def get_all_users(
+    request: Request,
+    carrera: Optional[str] = Query(None, description="Letra de la matrícula (S, D, G, T, K) o nombre de la carrera"),
+    matricula_prefix: Optional[str] = Query(None, description="Inicio de la matrícula, p.ej. la generación 2021"),
+    q: Optional[str] = Query(None, description="Texto a buscar en el nombre"),
+    modo: str = Query("prefix", regex="^(prefix|substring)$"),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    token: str = Depends(oauth2_scheme),
+):
     try:
-        result = await graph_service.get_all_users(token)
-        return result
+        snapshot = await graph_service.get_user_directory(token)
+
+        filtrado = any(v is not None for v in (carrera, matricula_prefix, q, limit)) or offset > 0
+        if not filtrado:
+            # Listado completo: bytes ya serializados y comprimidos para esta versión.
+            # El ETag sale del mismo listado para que no describa otra versión
+            etag, listado = await snapshot.listing()
+            encoding, body = listado.negotiate(request.headers.get("accept-encoding", ""))
+            # Si el cliente ya tiene esta versión del directorio, no se reenvía
+            headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+            if encoding != "identity":
+                # Cada codificación lleva su propio ETag; cualquiera vale para revalidar
+                headers["ETag"] = f'{etag[:-1]}-{encoding}"'
+            if request.headers.get("if-none-match") in (etag, headers["ETag"]):
+                return Response(status_code=304, headers=headers)
+            if encoding != "identity":
+                headers["Content-Encoding"] = encoding
+            return Response(content=body, media_type="application/json", headers=headers)
+
+        # La respuesta depende de la versión del directorio y de la consulta; entre
+        # leer el etag y consultar no hay await, así que ambos son de la misma versión
+        etag = '"' + hashlib.sha1(f"{snapshot.etag}?{request.url.query}".encode()).hexdigest() + '"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+        total, usuarios = snapshot.query(
+            carrera=carrera,
+            matricula_prefix=matricula_prefix,
+            q=q,
+            modo=modo,
+            offset=offset,
+            limit=limit
+        )
+        next_offset = offset + len(usuarios) if limit is not None and offset + len(usuarios) < total else None
+        return FastJSONResponse({
+            "usuarios": usuarios,
+            "total": total,
+            "offset": offset,
+            "next_offset": next_offset
+        }, headers=headers)
+    except DirectoryAccessDenied as e:
+        print(f"Directorio denegado: {e}")
+        raise HTTPException(status_code=403, detail="El directorio solo está disponible para cuentas de ITSA")
     except Exception as e:
         # Logea el error con más detalles
         print(f"Error al obtener usuarios: {e}")
-        raise HTTPException(status_code=500, detail="Error al obtener usuarios")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Error al obtener usuarios")
+
+
+# ✅ Alumnos en formato NDJSON (un JSON por línea) a medida que llegan de Graph
+# Con ordenar=true se sirven desde la copia local del directorio, ya ordenados
+@router.get("/stream")
+async def stream_users(ordenar: bool = False, token: str = Depends(oauth2_scheme)):
+    snapshot = None
+    try:
+        # Validar el token (y, para la copia local, su tenant) antes de empezar a responder
+        if ordenar:
+            snapshot = await graph_service.get_user_directory(token)
+        else:
+            await graph_service.get_me(token)
+    except DirectoryAccessDenied as e:
+        print(f"Directorio denegado: {e}")
+        raise HTTPException(status_code=403, detail="El directorio solo está disponible para cuentas de ITSA")
+    except Exception as e:
+        print(f"Error al obtener usuarios: {e}")
+        raise HTTPException(status_code=401, detail="Token inválido")
+
+    async def lineas():
+        try:
+            if snapshot is not None:
+                for i in range(0, len(snapshot.usuarios), 1000):
+                    yield b"".join(dumps(u) + b"\n" for u in snapshot.usuarios[i:i + 1000])
+            else:
+                # Un bloque de líneas por cada página de Graph
+                async for pagina in graph_service.stream_users(token):
+                    yield b"".join(dumps(u) + b"\n" for u in pagina)
+        except Exception as e:
+            # Los encabezados ya se enviaron: se avisa del error en la última línea
+            print(f"Error al obtener usuarios: {e}")
+            yield dumps({"error": "Error al obtener usuarios"}) + b"\n"
+
+    return StreamingResponse(lineas(), media_type="application/x-ndjson")
\ No newline at end of file
@@ -1,6 +1,14 @@
 from msal import ConfidentialClientApplication
+import asyncio
+import functools
 import os
-import httpx
+import threading
+import time
+from typing import Optional
+import requests
+from services.graph_service import graph_service
+from services.http_client import HTTP_TIMEOUT
+from app.auth.token_cache import token_cache, http_cache, refresh_sessions
 
 # Configuración desde variables de entorno
 CLIENT_ID = os.getenv("MSAL_CLIENT_ID")
@@ -18,61 +26,159 @@ SCOPES = [
 "User.Read",
 "User.ReadBasic.All"]
 
-app = ConfidentialClientApplication(
-    client_id=CLIENT_ID,
-    client_credential=CLIENT_SECRET,
-    authority=AUTHORITY
-)
+# Token de aplicación (client credentials) para sincronizar el directorio sin sesión de
+# usuario. Requiere el permiso de aplicación User.Read.All con consentimiento de admin.
+APP_SCOPES = ["https://graph.microsoft.com/.default"]
+DIRECTORY_APP_ONLY_SYNC = os.getenv("DIRECTORY_APP_ONLY_SYNC", "true").lower() in ("1", "true", "yes") and bool(CLIENT_SECRET)
+# Margen (segundos) con el que se renueva el token de aplicación antes de que venza
+APP_TOKEN_MARGIN = float(os.getenv("APP_TOKEN_MARGIN", "600"))
+
+
+def _login_session() -> requests.Session:
+    """Sesión (pool de conexiones) con la que MSAL habla con login.microsoftonline.com"""
+    session = requests.Session()
+    session.request = functools.partial(session.request, timeout=HTTP_TIMEOUT)
+    return session
+
+
+login_http_client = _login_session()
+_msal_app: Optional[ConfidentialClientApplication] = None
+_msal_lock = threading.Lock()
+
+
+def get_msal_app() -> ConfidentialClientApplication:
+    """
+    App de MSAL, creada una sola vez: en el arranque (warm_up_login) o, si la app
+    no pasó por el lifespan, en la primera llamada. Los metadatos de la autoridad
+    salen de MSAL_HTTP_CACHE_PATH cuando ya se descargaron antes.
+    """
+    global _msal_app
+    if _msal_app is None:
+        with _msal_lock:
+            if _msal_app is None:
+                if not CLIENT_ID or not TENANT_ID:
+                    raise RuntimeError("Faltan MSAL_CLIENT_ID o MSAL_TENANT_ID")
+                http_cache.load()
+                _msal_app = ConfidentialClientApplication(
+                    client_id=CLIENT_ID,
+                    client_credential=CLIENT_SECRET,
+                    authority=AUTHORITY,
+                    token_cache=token_cache,
+                    http_client=login_http_client,
+                    http_cache=http_cache
+                )
+                http_cache.save()
+    return _msal_app
+
+
+def warm_up_login():
+    """
+    Crea la app de MSAL y deja una conexión abierta con el endpoint de login para
+    que el primer /auth/callback no pague el handshake TLS.
+    """
+    get_msal_app()
+    # Fuera del http_cache de MSAL: si los metadatos venían del disco no hubo conexión
+    login_http_client.get(f"{AUTHORITY}/v2.0/.well-known/openid-configuration")
 
 
 def get_auth_url():
     """Genera URL de login con Microsoft"""
-    return app.get_authorization_request_url(
+    return get_msal_app().get_authorization_request_url(
         scopes=SCOPES,
         redirect_uri=REDIRECT_URI,
         state="some_random_state"  # IMPORTANTE: Genera un valor único en producción
     )
 
 def get_token_from_code(code: str):
-    """Intercambia el código por tokens"""
-    result = app.acquire_token_by_authorization_code(
-        code=code,
-        scopes=SCOPES,
-        redirect_uri=REDIRECT_URI
-    )
+    """
+    Intercambia el código por tokens. El refresh token queda en la caché de MSAL y
+    se agrega "refresh_session" para renovar el token después con refresh_access_token().
+    """
+    with token_cache.locked():
+        result = get_msal_app().acquire_token_by_authorization_code(
+            code=code,
+            scopes=SCOPES,
+            redirect_uri=REDIRECT_URI
+        )
     
     if "error" in result:
         raise Exception(result.get("error_description", "Error al obtener tokens"))
+
+    oid = result.get("id_token_claims", {}).get("oid")
+    if oid:
+        result["refresh_session"] = refresh_sessions.create(oid)
     
     return result
 
+def refresh_access_token(session: str) -> Optional[dict]:
+    """
+    Token nuevo para la sesión sin pasar por /auth/login (acquire_token_silent usa el
+    token en caché o el refresh token). None si hay que volver a iniciar sesión.
+    """
+    local_account_id = refresh_sessions.get(session)
+    if local_account_id is None:
+        return None
+
+    msal_app = get_msal_app()
+    with token_cache.locked():
+        account = next(
+            (a for a in msal_app.get_accounts() if a.get("local_account_id") == local_account_id),
+            None
+        )
+        result = msal_app.acquire_token_silent(SCOPES, account=account) if account else None
+
+    if not result or "access_token" not in result:
+        refresh_sessions.revoke(session)
+        return None
+    return result
+
+def _acquire_app_token() -> dict:
+    """
+    Token de aplicación desde la caché de tokens de MSAL (archivo 0600 compartido por
+    los workers) o, si no hay uno vigente, pedido a Entra ID. Bajo el lock del archivo:
+    si varios workers lo necesitan a la vez, solo uno lo pide y los demás lo leen.
+    """
+    msal_app = get_msal_app()
+    with token_cache.locked():
+        result = msal_app.acquire_token_silent(APP_SCOPES, account=None)
+        if not result or "access_token" not in result or float(result.get("expires_in", 0)) <= APP_TOKEN_MARGIN:
+            result = msal_app.acquire_token_for_client(scopes=APP_SCOPES)
+    if "access_token" not in result:
+        raise Exception(result.get("error_description", "Error al obtener el token de aplicación"))
+    return result
+
+_app_token: dict = {}
+_app_token_lock = asyncio.Lock()
+
+async def get_app_token() -> str:
+    """
+    Token de aplicación para trabajos en segundo plano. Da acceso a todo el directorio,
+    así que no pasa por la caché compartida (Redis/SQLite): se guarda en memoria hasta
+    APP_TOKEN_MARGIN segundos antes de vencer y, entre workers, en la caché de MSAL.
+    """
+    async with _app_token_lock:
+        if _app_token.get("expires_at", 0) - APP_TOKEN_MARGIN <= time.time():
+            result = await asyncio.to_thread(_acquire_app_token)
+            _app_token["access_token"] = result["access_token"]
+            _app_token["expires_at"] = time.time() + float(result.get("expires_in", 3600))
+        return _app_token["access_token"]
+
 async def get_user_info(access_token: str):
     """
     Obtiene información del usuario desde Microsoft Graph API
     """
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-    
     try:
-        # Primero obtiene el perfil básico
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://graph.microsoft.com/v1.0/me",
-                headers=headers
-            )
-            response.raise_for_status()
-            user_data = response.json()
-            
-            # Si necesitas más información, puedes hacer otras llamadas
-            # Por ejemplo, para obtener la foto o detalles adicionales
-            return {
-                "name": user_data.get("displayName", ""),
-                "email": user_data.get("mail") or user_data.get("userPrincipalName", ""),
-                # Agrega más campos según necesites
-            }
-            
+        # Primero obtiene el perfil básico (queda en caché para los envíos con este token)
+        user_data = await graph_service.get_me(access_token)
+        
+        # Si necesitas más información, puedes hacer otras llamadas
+        # Por ejemplo, para obtener la foto o detalles adicionales
+        return {
+            "name": user_data.get("displayName", ""),
+            "email": user_data.get("mail") or user_data.get("userPrincipalName", ""),
+            # Agrega más campos según necesites
+        }
+        
     except Exception as e:
         print(f"Error obteniendo info de usuario: {str(e)}")
         return {}
\ No newline at end of file
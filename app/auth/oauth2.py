@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import RedirectResponse
-from app.auth.msal_auth import get_auth_url, get_token_from_code,get_user_info
+from app.auth.msal_auth import get_auth_url, get_token_from_code, get_user_info, refresh_access_token
 from fastapi.responses import HTMLResponse
-import httpx
+from pydantic import BaseModel
+from services.http_client import get_http_client
+import asyncio
 router = APIRouter()
 
 @router.get("/login")
@@ -28,13 +30,11 @@ async def auth_callback(code: str, state: str = None, session_state: str = None)
         """
     
     try:
-        # 1. Obtener token usando el código
-        token_result = get_token_from_code(code)
-        print(token_result)
+        # 1. Obtener token usando el código (en un hilo: es una llamada de red bajo el lock de la caché de MSAL)
+        token_result = await asyncio.to_thread(get_token_from_code, code)
         
         # 2. Obtener información del usuario
         user_info = await get_user_info(token_result['access_token'])
-        print(user_info)
         # 3. Enviar datos al frontend y cerrar ventana
         return f"""
         <html>
@@ -52,6 +52,7 @@ async def auth_callback(code: str, state: str = None, session_state: str = None)
               window.opener.postMessage({{
                 type: 'MSAL_AUTH',
                 token: '{token_result["access_token"]}',
+                refreshSession: '{token_result.get("refresh_session", "")}',
                 user: {{
                   name: '{user_info.get("name", "")}',
                   email: '{user_info.get("email", "")}'
@@ -76,19 +77,36 @@ async def auth_callback(code: str, state: str = None, session_state: str = None)
         """
 
 
+class RefreshRequest(BaseModel):
+    session: str           # refreshSession recibido en /callback
+
+
+# Renueva el token sin redirigir a Microsoft mientras el refresh token siga vigente
+@router.post("/refresh")
+async def refresh(data: RefreshRequest):
+    result = await asyncio.to_thread(refresh_access_token, data.session)
+    if result is None:
+        raise HTTPException(status_code=401, detail="La sesión expiró, inicia sesión de nuevo")
+
+    return {
+        "access_token": result["access_token"],
+        "expires_in": result.get("expires_in")
+    }
+
+
 @router.get("/logout")   
 async def revoke_refresh_token(refresh_token: str, client_id: str, client_secret: str):
-    async with httpx.AsyncClient() as client:
-        data = {
-            "token": refresh_token,
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "token_type_hint": "refresh_token"
-        }
-        response = await client.post("https://login.microsoftonline.com/common/oauth2/v2.0/logout", data=data)
-        if response.status_code == 200:
-            return {"message": "Sesión cerrada correctamente"}
-        else:
-            raise Exception(f"No se pudo cerrar sesión: {response.text}")
+    client = get_http_client()
+    data = {
+        "token": refresh_token,
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "token_type_hint": "refresh_token"
+    }
+    response = await client.post("https://login.microsoftonline.com/common/oauth2/v2.0/logout", data=data)
+    if response.status_code == 200:
+        return {"message": "Sesión cerrada correctamente"}
+    else:
+        raise Exception(f"No se pudo cerrar sesión: {response.text}")
 
 
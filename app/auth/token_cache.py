@@ -0,0 +1,186 @@
+import hashlib
+import os
+import pickle
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from msal import SerializableTokenCache
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Archivo con la caché de tokens de MSAL (refresh tokens incluidos: no versionar)
+MSAL_TOKEN_CACHE_PATH = os.getenv("MSAL_TOKEN_CACHE_PATH", "msal_token_cache.bin")
+# Sesiones de refresco entregadas al frontend y cuánto duran (días)
+MSAL_SESSIONS_PATH = os.getenv("MSAL_SESSIONS_PATH", "msal_sessions.db")
+MSAL_SESSION_DAYS = float(os.getenv("MSAL_SESSION_DAYS", "90"))
+# Metadatos de la autoridad (openid-configuration) que MSAL descarga al crearse
+MSAL_HTTP_CACHE_PATH = os.getenv("MSAL_HTTP_CACHE_PATH", "msal_http_cache.bin")
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Lock exclusivo entre procesos (workers de uvicorn) sobre un archivo auxiliar"""
+    with open(path, "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FileTokenCache(SerializableTokenCache):
+    """
+    Caché de tokens de MSAL guardada en disco y compartida entre workers.
+    Las llamadas a MSAL se hacen dentro de locked(): se toma el lock del archivo,
+    se relee si otro proceso lo cambió y al salir se guarda si hubo cambios.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._lock_path = f"{path}.lock"
+        self._thread_lock = threading.RLock()
+        self._mtime: Optional[float] = None
+
+    def _reload(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            self.deserialize(f.read())
+        self._mtime = mtime
+
+    def _persist(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.serialize())
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+        self._mtime = os.path.getmtime(self.path)
+        self.has_state_changed = False
+
+    @contextmanager
+    def locked(self):
+        with self._thread_lock, _file_lock(self._lock_path):
+            self._reload()
+            try:
+                yield self
+            finally:
+                if self.has_state_changed:
+                    try:
+                        self._persist()
+                    except OSError as e:
+                        print(f"No se pudo guardar la caché de tokens: {e}")
+
+
+class FileHttpCache(dict):
+    """
+    http_cache de MSAL guardado en disco: con los metadatos de la autoridad ya
+    descargados, crear la app de MSAL no sale a la red. MSAL guarda aquí solo
+    respuestas de descubrimiento (con su vencimiento), nunca tokens.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._lock_path = f"{path}.lock"
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:  # archivo dañado o de otra versión de MSAL: se empieza de cero
+            print(f"No se pudo leer la caché HTTP de MSAL: {e}")
+            return
+        if isinstance(data, dict):
+            self.update(data)
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with _file_lock(self._lock_path):
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(dict(self), f)
+                os.replace(tmp_path, self.path)
+        except (OSError, pickle.PicklingError) as e:
+            print(f"No se pudo guardar la caché HTTP de MSAL: {e}")
+
+
+def _hash(session: str) -> str:
+    return hashlib.sha256(session.encode()).hexdigest()
+
+
+class RefreshSessions:
+    """
+    Sesiones opacas que el frontend usa para pedir un token nuevo sin volver a
+    iniciar sesión. Cada una apunta a la cuenta de MSAL (oid) cuyo refresh token
+    está en la caché; en la base solo se guarda el hash de la sesión.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_hash TEXT PRIMARY KEY,"
+                " local_account_id TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def create(self, local_account_id: str) -> str:
+        session = secrets.token_urlsafe(32)
+        with self._lock:
+            self._connection().execute(
+                "INSERT INTO sessions (session_hash, local_account_id, expires_at) VALUES (?, ?, ?)",
+                (_hash(session), local_account_id, time.time() + MSAL_SESSION_DAYS * 86400)
+            )
+        return session
+
+    def get(self, session: str) -> Optional[str]:
+        with self._lock:
+            fila = self._connection().execute(
+                "SELECT local_account_id, expires_at FROM sessions WHERE session_hash = ?",
+                (_hash(session),)
+            ).fetchone()
+        if fila is None or fila[1] <= time.time():
+            return None
+        return fila[0]
+
+    def revoke(self, session: str):
+        with self._lock:
+            self._connection().execute("DELETE FROM sessions WHERE session_hash = ?", (_hash(session),))
+
+
+token_cache = FileTokenCache(MSAL_TOKEN_CACHE_PATH)
+http_cache = FileHttpCache(MSAL_HTTP_CACHE_PATH)
+refresh_sessions = RefreshSessions(MSAL_SESSIONS_PATH)
@@ -0,0 +1,188 @@
+"""
+Microsoft Graph de mentira para los benchmarks: un httpx.MockTransport que atiende
+las rutas que usa la app (/me, /users, /users/delta, /chats, /messages, /members,
+$batch, createUploadSession, subida por fragmentos y miniaturas) sin salir a la red.
+
+La latencia, la proporción de respuestas 429 y el tamaño del tenant se configuran
+al crear FakeGraph.
+"""
+import asyncio
+import itertools
+import json
+import random
+import re
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+
+CARRERAS = "SDGTK"
+UPLOAD_HOST = "upload.fake.local"
+
+
+def _respuesta(status: int, body=None, headers: Optional[dict] = None) -> httpx.Response:
+    if body is None:
+        return httpx.Response(status, headers=headers)
+    return httpx.Response(status, json=body, headers=headers)
+
+
+class FakeGraph:
+    """
+    latency:     segundos que tarda cada petición HTTP (un $batch cuenta una vez)
+    throttle:    probabilidad de responder 429 a una petición o sub-petición
+    retry_after: valor de Retry-After en los 429 (segundos)
+    tenant_size: usuarios del tenant; ~90 % con correo de matrícula, el resto personal
+    page_size:   usuarios por página de /users y /users/delta
+    """
+
+    def __init__(self, base_url: str, latency: float = 0.0, throttle: float = 0.0, retry_after: float = 0.0,
+                 tenant_size: int = 1000, page_size: int = 999, seed: int = 1):
+        self.graph_url = base_url.rstrip("/")
+        self.base_path = urlparse(self.graph_url).path
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+
+        self.me = {"id": "sender-0001", "displayName": "Docente Benchmark", "mail": "docente@itsa.edu.mx"}
+        self.users = [self._usuario(i) for i in range(tenant_size)]
+        self.chats = {}
+        self.uploads = {}
+        self.items = {}
+        self.requests = 0
+        self.throttled = 0
+
+    def _usuario(self, i: int) -> dict:
+        if i % 10 == 9:
+            mail = f"personal{i}@itsa.edu.mx"
+        else:
+            mail = f"{2018 + i % 7}{CARRERAS[i % 5]}{i:05d}@itsa.edu.mx"
+        return {
+            "id": f"user-{i:06d}",
+            "displayName": f"Alumno {self._random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')}{i:06d}",
+            "mail": mail,
+            "userPrincipalName": mail
+        }
+
+    @property
+    def student_ids(self):
+        return [u["id"] for u in self.users if not u["mail"].startswith("personal")]
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def _limitar(self) -> bool:
+        if self.throttle and self._random.random() < self.throttle:
+            self.throttled += 1
+            return True
+        return False
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._limitar():
+            return _respuesta(429, {"error": {"code": "TooManyRequests"}}, {"Retry-After": str(self.retry_after)})
+
+        if request.url.host == UPLOAD_HOST:
+            return self._subida(request)
+
+        path = request.url.path[len(self.base_path):]
+        if path == "/$batch":
+            return self._batch(json.loads(request.content))
+
+        body = json.loads(request.content) if request.content else None
+        status, data = self._route(request.method, path, request.url.query.decode(), body)
+        return _respuesta(status, data)
+
+    def _batch(self, envelope: dict) -> httpx.Response:
+        responses = []
+        for sub in envelope["requests"]:
+            if self._limitar():
+                responses.append({"id": sub["id"], "status": 429, "headers": {"Retry-After": str(self.retry_after)},
+                                  "body": {"error": {"code": "TooManyRequests"}}})
+                continue
+            url = urlparse(sub["url"])
+            status, data = self._route(sub["method"], url.path, url.query, sub.get("body"))
+            responses.append({"id": sub["id"], "status": status, "body": data})
+        return _respuesta(200, {"responses": responses})
+
+    def _route(self, method: str, path: str, query: str, body):
+        if path == "/me":
+            return 200, self.me
+        if path in ("/users", "/users/delta"):
+            return self._usuarios(path, query)
+        if method == "POST" and path == "/chats":
+            chat_id = f"chat-{next(self._ids)}"
+            self.chats[chat_id] = {m["user@odata.bind"].rsplit("/", 1)[-1] for m in body.get("members", [])}
+            return 201, {"id": chat_id, "chatType": body.get("chatType")}
+
+        m = re.fullmatch(r"/chats/([^/]+)/(messages|members)(?:/([^/]+))?", path)
+        if m:
+            chat_id, coleccion, miembro = m.groups()
+            if chat_id not in self.chats:
+                return 404, {"error": {"code": "NotFound"}}
+            if coleccion == "messages":
+                return 201, {"id": f"msg-{next(self._ids)}", "chatId": chat_id}
+            if method == "GET":
+                return 200, {"value": [{"id": f"m-{u}", "userId": u} for u in self.chats[chat_id]]}
+            if method == "POST":
+                self.chats[chat_id].add(body["user@odata.bind"].rsplit("/", 1)[-1])
+                return 201, {}
+            self.chats[chat_id].discard(miembro[2:])
+            return 204, None
+
+        m = re.fullmatch(r"/me/drive/root:/(.+):/createUploadSession", path)
+        if m:
+            session = f"s{next(self._ids)}"
+            self.uploads[session] = {"name": m.group(1), "received": 0}
+            return 200, {"uploadUrl": f"https://{UPLOAD_HOST}/{session}"}
+
+        m = re.fullmatch(r"/me/drive/items/([^/]+)(/thumbnails/0/medium)?", path)
+        if m:
+            item = self.items.get(m.group(1))
+            if item is None:
+                return 404, {"error": {"code": "itemNotFound"}}
+            if m.group(2):
+                return 200, {"url": f"https://thumbs.fake.local/{item['id']}.png", "width": 176, "height": 176}
+            return 200, {**item, "thumbnails": [{"medium": {"url": f"https://thumbs.fake.local/{item['id']}.png"}}]}
+
+        return 404, {"error": {"code": "NotFound", "message": f"{method} {path}"}}
+
+    def _usuarios(self, path: str, query: str):
+        params = parse_qs(query)
+        if "$deltatoken" in params:
+            # Sin cambios desde la última sincronización
+            return 200, {"value": [], "@odata.deltaLink": f"{self.graph_url}{path}?$deltatoken=latest"}
+
+        inicio = int(params.get("$skiptoken", ["0"])[0])
+        fin = inicio + self.page_size
+        data = {"value": self.users[inicio:fin]}
+        if fin < len(self.users):
+            data["@odata.nextLink"] = f"{self.graph_url}{path}?$skiptoken={fin}"
+        elif path == "/users/delta":
+            data["@odata.deltaLink"] = f"{self.graph_url}{path}?$deltatoken=latest"
+        return 200, data
+
+    def _subida(self, request: httpx.Request) -> httpx.Response:
+        session = request.url.path.strip("/")
+        estado = self.uploads.get(session)
+        if estado is None:
+            return _respuesta(404, {"error": {"code": "itemNotFound"}})
+        if request.method == "GET":
+            return _respuesta(200, {"nextExpectedRanges": [f"{estado['received']}-"]})
+
+        inicio, fin, total = map(int, re.match(r"bytes (\d+)-(\d+)/(\d+)", request.headers["content-range"]).groups())
+        if inicio != estado["received"]:
+            return _respuesta(416, {"nextExpectedRanges": [f"{estado['received']}-"]})
+        estado["received"] = fin + 1
+        if estado["received"] < total:
+            return _respuesta(202, {"nextExpectedRanges": [f"{estado['received']}-"]})
+
+        item_id = f"item-{next(self._ids)}"
+        self.items[item_id] = {"id": item_id, "name": estado["name"], "size": total,
+                               "webUrl": f"https://onedrive.fake.local/{item_id}"}
+        del self.uploads[session]
+        return _respuesta(201, self.items[item_id])
@@ -0,0 +1,111 @@
+"""
+Servidor RESP mínimo en memoria para probar CACHE_BACKEND=redis sin instalar Redis.
+Atiende los comandos que usa services/cache_backend.py: PING, AUTH, SELECT, GET,
+MGET, SET (con PX y NX), DEL y el EVAL con el que se liberan los locks.
+
+    python -m bench.fake_redis --port 6390
+"""
+import argparse
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+
+
+class FakeRedis:
+    def __init__(self):
+        self._values: Dict[bytes, Tuple[Optional[float], bytes]] = {}
+        self.commands = 0
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._values[key]
+            return None
+        return value
+
+    def _ejecutar(self, args):
+        comando = args[0].upper()
+        if comando in (b"PING", b"AUTH", b"SELECT"):
+            return "OK"
+        if comando == b"GET":
+            return self._get(args[1])
+        if comando == b"MGET":
+            return [self._get(key) for key in args[1:]]
+        if comando == b"DEL":
+            return sum(self._values.pop(key, None) is not None for key in args[1:])
+        if comando == b"EVAL":
+            # Solo se entiende el script de liberación de locks (RELEASE_LOCK_SCRIPT:
+            # comparar y borrar). No se importa: la caché lee REDIS_URL al importarse
+            if b'redis.call("DEL"' not in args[1] or args[2] != b"1":
+                return RuntimeError("ERR script no soportado por el servidor de prueba")
+            key, token = args[3], args[4]
+            if self._get(key) == token:
+                del self._values[key]
+                return 1
+            return 0
+        if comando == b"SET":
+            key, value, opciones = args[1], args[2], [a.upper() for a in args[3:]]
+            expires_at = None
+            if b"PX" in opciones:
+                expires_at = time.monotonic() + int(args[3 + opciones.index(b"PX") + 1]) / 1000
+            if b"NX" in opciones and self._get(key) is not None:
+                return None
+            self._values[key] = (expires_at, value)
+            return "OK"
+        return RuntimeError(f"ERR unknown command '{comando.decode()}'")
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode()
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, bytes):
+            return b"$%d\r\n%s\r\n" % (len(value), value)
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(FakeRedis._encode(v) for v in value)
+        return b"-%s\r\n" % str(value).encode()
+
+    async def _cliente(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                linea = await reader.readline()
+                if not linea:
+                    break
+                args = []
+                for _ in range(int(linea[1:-2])):
+                    largo = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(largo + 2))[:-2])
+                self.commands += 1
+                writer.write(self._encode(self._ejecutar(args)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> asyncio.AbstractServer:
+        """Abre el servidor; con port=0 el sistema elige el puerto (server.sockets[0])"""
+        return await asyncio.start_server(self._cliente, host, port)
+
+
+async def _main(args):
+    server = await FakeRedis().start(args.host, args.port)
+    print(f"RESP en memoria escuchando en {args.host}:{server.sockets[0].getsockname()[1]}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor RESP mínimo en memoria")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,302 @@
+"""
+Benchmarks de la app (main.py) contra un Graph local (bench/fake_graph.py).
+
+    python -m bench.run                          # todo, con los valores por defecto
+    python -m bench.run --only sends --latency 0.05 --throttle 0.02
+    python -m bench.run --only users --tenants 1000,50000 --json resultados.json
+    python -m bench.run --cache-backend redis    # caché compartida en bench/fake_redis.py
+
+Mide:
+  - sends:  envíos por segundo de /send-message-with-attachment a 10/100/1000
+            destinatarios, en frío (crea chats y sube el archivo) y en caliente
+            (chats y adjunto ya en caché)
+  - users:  tiempo y memoria de /api/users/all con tenants de 1k y 50k usuarios
+  - upload: rendimiento de la subida por fragmentos según el tamaño del archivo
+
+La app se ejecuta en el mismo proceso con httpx.ASGITransport; el cliente HTTP
+compartido se abre con el transporte del Graph falso, así que no sale nada a la red.
+Los límites de ritmo (GRAPH_TENANT_RATE, GRAPH_SENDER_RATE...) son los del entorno
+salvo que se indiquen con --tenant-rate / --sender-rate.
+"""
+import argparse
+import asyncio
+import base64
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import asynccontextmanager
+
+GRAPH_URL = "https://graph.fake.local/v1.0"
+
+
+def _argumentos():
+    parser = argparse.ArgumentParser(description="Benchmarks contra un Microsoft Graph local")
+    parser.add_argument("--only", choices=("sends", "users", "upload"), action="append",
+                        help="escenario a ejecutar (se puede repetir); por defecto todos")
+    parser.add_argument("--latency", type=float, default=0.02, help="latencia por petición a Graph (s)")
+    parser.add_argument("--throttle", type=float, default=0.0, help="proporción de respuestas 429 (0-1)")
+    parser.add_argument("--retry-after", type=float, default=0.0, help="Retry-After de los 429 (s)")
+    parser.add_argument("--recipients", default="10,100,1000")
+    parser.add_argument("--tenants", default="1000,50000")
+    parser.add_argument("--file-sizes", default="1,10,50", help="tamaños de archivo en MiB")
+    parser.add_argument("--attachment-kib", type=int, default=100, help="tamaño del adjunto en el escenario sends")
+    parser.add_argument("--tenant-rate", type=float, help="GRAPH_TENANT_RATE para la corrida")
+    parser.add_argument("--sender-rate", type=float, help="GRAPH_SENDER_RATE para la corrida")
+    parser.add_argument("--cache-backend", choices=("memory", "sqlite", "redis"), default="sqlite",
+                        help="CACHE_BACKEND de la corrida; redis usa el servidor RESP de bench/fake_redis.py")
+    parser.add_argument("--json", help="archivo donde guardar los resultados")
+    return parser.parse_args()
+
+
+def _preparar_entorno(args, directorio: str):
+    """La configuración se lee al importar los módulos: hay que fijarla antes"""
+    os.environ["GRAPH_BASE_URL"] = GRAPH_URL
+    os.environ["DIRECTORY_APP_ONLY_SYNC"] = "false"
+    os.environ["CACHE_BACKEND"] = args.cache_backend
+    os.environ.setdefault("MSAL_TENANT_ID", "bench")
+    os.environ["DIRECTORY_TENANT_ID"] = "bench-tenant"  # el "tid" de los tokens de _token()
+    os.environ.setdefault("MSAL_CLIENT_ID", "bench")
+    for variable, archivo in (
+        ("CACHE_SQLITE_PATH", "shared_cache.db"),
+        ("ATTACHMENT_CACHE_PATH", "attachment_cache.db"),
+        ("GROUP_CHAT_CACHE_PATH", "group_chats.db"),
+        ("JOBS_DB_PATH", "jobs.db"),
+        ("DIRECTORY_SNAPSHOT_PATH", "directory_snapshot.json"),
+        ("MSAL_TOKEN_CACHE_PATH", "msal_token_cache.bin"),
+        ("MSAL_SESSIONS_PATH", "msal_sessions.db"),
+        ("MSAL_HTTP_CACHE_PATH", "msal_http_cache.bin"),
+    ):
+        os.environ[variable] = os.path.join(directorio, archivo)
+    if args.tenant_rate:
+        os.environ["GRAPH_TENANT_RATE"] = str(args.tenant_rate)
+        os.environ["GRAPH_TENANT_BURST"] = str(args.tenant_rate * 2)
+    if args.sender_rate:
+        os.environ["GRAPH_SENDER_RATE"] = str(args.sender_rate)
+        os.environ["GRAPH_SENDER_BURST"] = str(args.sender_rate * 2)
+
+
+class _DescubrimientoLocal:
+    """
+    Cliente HTTP para MSAL que responde el openid-configuration sin red: el arranque
+    crea la app de MSAL y calienta el login, y en el benchmark no hay inicio de sesión.
+    """
+
+    class _Respuesta:
+        status_code = 200
+        headers = {}
+
+        def __init__(self, data):
+            self.text = json.dumps(data)
+
+        def raise_for_status(self):
+            pass
+
+    def get(self, url, **kwargs):
+        base = "https://login.microsoftonline.com/bench"
+        return self._Respuesta({
+            "authorization_endpoint": f"{base}/oauth2/v2.0/authorize",
+            "token_endpoint": f"{base}/oauth2/v2.0/token",
+            "device_authorization_endpoint": f"{base}/oauth2/v2.0/devicecode",
+            "issuer": f"{base}/v2.0",
+        })
+
+    post = get
+
+    def close(self):
+        pass
+
+
+def _token(sender_id: str) -> str:
+    import jwt
+    return jwt.encode(
+        {"oid": sender_id, "tid": "bench-tenant", "exp": int(time.time()) + 3600},
+        "bench", algorithm="HS256"
+    )
+
+
+@asynccontextmanager
+async def _app_contra(fake):
+    """La app completa (lifespan incluido) hablando con el Graph falso"""
+    import httpx
+    import main
+    from app.auth import msal_auth
+    from services import http_client
+
+    msal_auth.login_http_client = _DescubrimientoLocal()
+    await http_client.close_http_client()
+    await http_client.start_http_client(fake.transport())
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as api:
+            # Como el balanceador: sin tráfico hasta que la réplica está caliente
+            while (await api.get("/ready")).status_code != 200:
+                await asyncio.sleep(0.01)
+            yield api
+
+
+def _fake(args, **kwargs):
+    from bench.fake_graph import FakeGraph
+    return FakeGraph(GRAPH_URL, latency=args.latency, throttle=args.throttle, retry_after=args.retry_after, **kwargs)
+
+
+async def bench_sends(args):
+    resultados = []
+    adjunto = base64.b64encode(os.urandom(args.attachment_kib * 1024)).decode()
+    for n in [int(x) for x in args.recipients.split(",")]:
+        fake = _fake(args, tenant_size=max(1000, n * 2))
+        # Un remitente distinto por tamaño para empezar sin chats en caché
+        fake.me["id"] = f"sender-sends-{n}"
+        token = _token(fake.me["id"])
+        destinatarios = fake.student_ids[:n]
+
+        async with _app_contra(fake) as api:
+            for fase in ("cold", "warm"):
+                peticiones, limitadas = fake.requests, fake.throttled
+                inicio = time.perf_counter()
+                response = await api.post(
+                    "/api/teams/send-message-with-attachment",
+                    headers={"Authorization": f"Bearer {token}"},
+                    json={"id": destinatarios, "message": "Aviso de prueba", "file": adjunto, "file_name": "aviso.pdf"}
+                )
+                duracion = time.perf_counter() - inicio
+                data = response.json()
+                resultados.append({
+                    "recipients": n,
+                    "phase": fase,
+                    "seconds": round(duracion, 3),
+                    "sends_per_second": round(data.get("sent", 0) / duracion, 1),
+                    "sent": data.get("sent"),
+                    "failed": data.get("failed"),
+                    "graph_requests": fake.requests - peticiones,
+                    "throttled": fake.throttled - limitadas,
+                })
+                print(f"sends  n={n:<5} {fase:<4} {duracion:8.3f}s  {resultados[-1]['sends_per_second']:8.1f} envíos/s"
+                      f"  ok={data.get('sent')} error={data.get('failed')}"
+                      f"  peticiones={resultados[-1]['graph_requests']} 429={resultados[-1]['throttled']}")
+    return resultados
+
+
+async def _listar_usuarios(api, token: str):
+    inicio = time.perf_counter()
+    response = await api.get("/api/users/all", headers={"Authorization": f"Bearer {token}"})
+    duracion = time.perf_counter() - inicio
+    response.raise_for_status()
+    return duracion, len(response.content), len(response.json()["usuarios"])
+
+
+def _reiniciar_directorio():
+    from services.directory import directory
+    try:
+        os.remove(directory.path)
+    except OSError:
+        pass
+    directory.__init__(directory.path)
+    gc.collect()
+
+
+async def bench_users(args):
+    resultados = []
+    for tamaño in [int(x) for x in args.tenants.split(",")]:
+        fake = _fake(args, tenant_size=tamaño)
+        fake.me["id"] = f"sender-users-{tamaño}"
+        token = _token(fake.me["id"])
+
+        async with _app_contra(fake) as api:
+            _reiniciar_directorio()
+            frio, tamaño_respuesta, alumnos = await _listar_usuarios(api, token)
+            caliente, _, _ = await _listar_usuarios(api, token)
+
+            # La memoria se mide en otra corrida en frío: tracemalloc frena la ejecución
+            _reiniciar_directorio()
+            tracemalloc.start()
+            await _listar_usuarios(api, token)
+            _, pico = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        resultados.append({
+            "tenant_size": tamaño,
+            "students": alumnos,
+            "cold_seconds": round(frio, 3),
+            "warm_seconds": round(caliente, 4),
+            "response_bytes": tamaño_respuesta,
+            "peak_memory_mib": round(pico / 2 ** 20, 1),
+        })
+        print(f"users  tenant={tamaño:<6} alumnos={alumnos:<6} frío={frio:7.3f}s  caliente={caliente:7.4f}s"
+              f"  respuesta={tamaño_respuesta / 2 ** 20:6.2f} MiB  pico={pico / 2 ** 20:7.1f} MiB")
+    return resultados
+
+
+async def bench_upload(args):
+    resultados = []
+    fake = _fake(args, tenant_size=10)
+    fake.me["id"] = "sender-upload"
+    token = _token(fake.me["id"])
+    destinatario = fake.student_ids[:1]
+
+    async with _app_contra(fake) as api:
+        for mib in [int(x) for x in args.file_sizes.split(",")]:
+            contenido = os.urandom(mib * 2 ** 20)  # contenido nuevo: sin reutilizar adjuntos
+            peticiones = fake.requests
+            inicio = time.perf_counter()
+            response = await api.post(
+                "/api/teams/send-message-with-attachment/upload",
+                headers={"Authorization": f"Bearer {token}"},
+                data={"message": "Archivo de prueba", "id": destinatario},
+                files={"file": (f"archivo-{mib}mib.bin", contenido, "application/octet-stream")}
+            )
+            duracion = time.perf_counter() - inicio
+            response.raise_for_status()
+            resultados.append({
+                "file_mib": mib,
+                "seconds": round(duracion, 3),
+                "mib_per_second": round(mib / duracion, 1),
+                "graph_requests": fake.requests - peticiones,
+            })
+            print(f"upload {mib:>4} MiB  {duracion:8.3f}s  {mib / duracion:8.1f} MiB/s"
+                  f"  peticiones={resultados[-1]['graph_requests']}")
+    return resultados
+
+
+ESCENARIOS = {"sends": bench_sends, "users": bench_users, "upload": bench_upload}
+
+
+async def _ejecutar(args):
+    resultados = {
+        "config": {"latency": args.latency, "throttle": args.throttle, "retry_after": args.retry_after,
+                   "cache_backend": args.cache_backend, "python": sys.version.split()[0]}
+    }
+    redis = None
+    if args.cache_backend == "redis":
+        # Antes de importar la app: REDIS_URL se lee al importar services.cache_backend
+        from bench.fake_redis import FakeRedis
+        redis = await FakeRedis().start()
+        os.environ["REDIS_URL"] = f"redis://127.0.0.1:{redis.sockets[0].getsockname()[1]}/0"
+    try:
+        for nombre in args.only or list(ESCENARIOS):
+            resultados[nombre] = await ESCENARIOS[nombre](args)
+    finally:
+        if redis is not None:
+            from services.cache_backend import cache_backend
+            await cache_backend.close()
+            redis.close()
+            await redis.wait_closed()
+    return resultados
+
+
+def main():
+    args = _argumentos()
+    with tempfile.TemporaryDirectory(prefix="itsa-bench-") as directorio:
+        _preparar_entorno(args, directorio)
+        resultados = asyncio.run(_ejecutar(args))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
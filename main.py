@@ -1,10 +1,48 @@
-from fastapi import FastAPI
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from app.api import users
 from app.api import teams
 from app.auth.oauth2 import router as auth_router
+from services.http_client import start_http_client, close_http_client, warm_up_graph
+from services.jobs import job_queue
+from services.directory import directory
+from services.cache_backend import cache_backend
+from services import metrics
+from services.readiness import readiness
+from services.serialization import StreamingAwareGZipMiddleware
+from app.auth.msal_auth import DIRECTORY_APP_ONLY_SYNC, get_app_token, warm_up_login
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Un solo cliente HTTP (pool de conexiones) para Graph y login durante toda la vida de la app
+    await start_http_client()
+    # Workers de envíos en segundo plano (retoman los que quedaron a medias)
+    await job_queue.start()
+    # Directorio sincronizado con el token de aplicación, sin esperar a que alguien inicie sesión
+    if DIRECTORY_APP_ONLY_SYNC:
+        directory.start_background_sync(get_app_token)
+    # MSAL (con los metadatos de la autoridad en disco), conexiones a Graph y login, y
+    # el directorio: se preparan aquí y no en las primeras peticiones. /ready da 503 hasta terminar
+    readiness.start({
+        "msal": lambda: asyncio.to_thread(warm_up_login),
+        "graph": warm_up_graph,
+        "directory": directory.warm_up,
+    })
+    yield
+    await readiness.stop()
+    await directory.stop_background_sync()
+    await job_queue.stop()
+    await close_http_client()
+    await cache_backend.close()
+
+
+app = FastAPI(lifespan=lifespan)
 # Configura CORS
 app.add_middleware(
     CORSMiddleware,
@@ -13,6 +51,32 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compresión del resto de respuestas; las que ya traen Content-Encoding (p.ej. el
+# listado precomprimido de /api/users/all) pasan sin volver a comprimirse, y el
+# stream NDJSON va sin comprimir para que cada página llegue al cliente en cuanto sale
+app.add_middleware(
+    StreamingAwareGZipMiddleware,
+    exclude_paths=("/api/users/stream",),
+    minimum_size=1024,
+    compresslevel=int(os.getenv("HTTP_GZIP_LEVEL", "5"))
+)
+
+
+# Tiempo de respuesta por ruta (la plantilla, p.ej. /api/teams/jobs/{job_id}, para no disparar etiquetas)
+@app.middleware("http")
+async def medir_peticion(request: Request, call_next):
+    inicio = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        duracion = time.perf_counter() - inicio
+        route = request.scope.get("route")
+        ruta = route.path if route is not None else "unmatched"
+        metrics.HTTP_REQUEST_SECONDS.observe(duracion, method=request.method, route=ruta, status=status)
+        metrics.log_event("http_request", method=request.method, route=ruta, status=status, seconds=round(duracion, 4))
 
 
 # Incluye los routers
@@ -25,3 +89,19 @@ def read_root():
     return {"message": "Backend ITSA Avisos"}
 
 
+# Métricas en formato Prometheus (latencias de Graph, 429, reintentos, bytes subidos...)
+@app.get("/metrics")
+def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# Liveness: el proceso responde
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+
+# Readiness: 503 hasta que termina el calentamiento del arranque (para el balanceador)
+@app.get("/ready")
+def ready():
+    return JSONResponse(readiness.status(), status_code=200 if readiness.ready else 503)
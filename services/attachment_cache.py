@@ -0,0 +1,77 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import BinaryIO, Optional
+
+# Archivo SQLite con los adjuntos ya subidos a OneDrive
+ATTACHMENT_CACHE_PATH = os.getenv("ATTACHMENT_CACHE_PATH", "attachment_cache.db")
+
+
+def content_hash(file_obj: BinaryIO, file_name: str = "") -> str:
+    """
+    SHA-256 del nombre y del contenido, leído por bloques; deja el archivo al inicio.
+    El nombre entra en la clave porque es el del archivo en OneDrive y el de la tarjeta.
+    Lee el archivo completo: llamarlo en un hilo (asyncio.to_thread).
+    """
+    file_obj.seek(0)
+    digest = hashlib.sha256(file_name.encode() + b"\0")
+    for bloque in iter(lambda: file_obj.read(1024 * 1024), b""):
+        digest.update(bloque)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+
+class AttachmentCache:
+    """
+    Caché persistente (sender_id, hash del nombre y contenido) -> driveItem subido.
+    Si se vuelve a mandar el mismo archivo se reutiliza en lugar de subir otra copia.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS attachments ("
+                " sender_id TEXT NOT NULL,"
+                " content_hash TEXT NOT NULL,"
+                " item_id TEXT NOT NULL,"
+                " web_url TEXT NOT NULL,"
+                " thumbnail_url TEXT,"
+                " PRIMARY KEY (sender_id, content_hash))"
+            )
+            self._conn = conn
+        return self._conn
+
+    def get(self, sender_id: str, digest: str) -> Optional[dict]:
+        with self._lock:
+            fila = self._connection().execute(
+                "SELECT item_id, web_url, thumbnail_url FROM attachments WHERE sender_id = ? AND content_hash = ?",
+                (sender_id, digest)
+            ).fetchone()
+        return dict(fila) if fila else None
+
+    def set(self, sender_id: str, digest: str, item_id: str, web_url: str, thumbnail_url: Optional[str]):
+        with self._lock:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO attachments (sender_id, content_hash, item_id, web_url, thumbnail_url)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (sender_id, digest, item_id, web_url, thumbnail_url)
+            )
+
+    def invalidate(self, sender_id: str, digest: str):
+        with self._lock:
+            self._connection().execute(
+                "DELETE FROM attachments WHERE sender_id = ? AND content_hash = ?",
+                (sender_id, digest)
+            )
+
+
+attachment_cache = AttachmentCache(ATTACHMENT_CACHE_PATH)
@@ -0,0 +1,472 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import unquote, urlparse
+
+from services.serialization import dumps, loads
+
+# Dónde se guarda el estado compartido entre workers de uvicorn:
+#   memory -> solo este proceso; se pierde al reiniciar (los chats se vuelven a crear)
+#   sqlite -> archivo local en WAL, compartido por los workers de la misma máquina
+#   redis  -> cualquier servidor que hable RESP (Redis, Valkey, KeyDB...)
+# Por defecto sqlite: además de compartirse entre workers, sobrevive a reinicios y
+# despliegues (los chat ids de chat_cache no se vuelven a pedir a Graph)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite").lower()
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", "shared_cache.db")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Espera máxima por un lock de single-flight antes de hacer la llamada de todos modos
+CACHE_LOCK_WAIT = float(os.getenv("CACHE_LOCK_WAIT", "30"))
+CACHE_POLL_INTERVAL = 0.05
+
+
+class CacheBackend:
+    """
+    Almacén clave -> bytes con TTL opcional y locks con vencimiento. Todas las
+    operaciones son async para que un backend de red no bloquee el event loop.
+    """
+
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        encontrados = {}
+        for key in keys:
+            value = await self.get(key)
+            if value is not None:
+                encontrados[key] = value
+        return encontrados
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    async def set_many(self, items: Dict[str, bytes], ttl: Optional[float] = None):
+        for key, value in items.items():
+            await self.set(key, value, ttl)
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        """Devuelve un token si se obtuvo el lock, None si otro lo tiene"""
+        raise NotImplementedError
+
+    async def release_lock(self, key: str, token: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """Diccionario del proceso: sirve con un solo worker"""
+
+    def __init__(self):
+        self._values: Dict[str, Tuple[Optional[float], bytes]] = {}
+        self._locks: Dict[str, Tuple[float, str]] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.time():
+            self._values.pop(key, None)
+            return None
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        now = time.time()
+        if len(self._values) % 1000 == 0:
+            # Limpiar entradas vencidas de vez en cuando para que no crezca sin límite
+            for vencida in [k for k, (vence, _) in self._values.items() if vence is not None and vence <= now]:
+                del self._values[vencida]
+        self._values[key] = (now + ttl if ttl is not None else None, value)
+
+    async def delete(self, key: str):
+        self._values.pop(key, None)
+
+    async def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        now = time.time()
+        actual = self._locks.get(key)
+        if actual is not None and actual[0] > now:
+            return None
+        token = uuid.uuid4().hex
+        self._locks[key] = (now + ttl, token)
+        return token
+
+    async def release_lock(self, key: str, token: str):
+        if self._locks.get(key, (0, None))[1] == token:
+            del self._locks[key]
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Tabla clave/valor en un archivo SQLite (WAL). Los workers de la misma máquina
+    comparten el archivo, y los locks se toman con BEGIN IMMEDIATE. Las consultas
+    corren en un hilo (asyncio.to_thread) para no bloquear el event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._escrituras = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Solo el usuario del proceso puede leerla (SQLite copia el modo a -wal y -shm):
+            # guarda identidades y chats de los usuarios
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            os.chmod(self.path, 0o600)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " key TEXT PRIMARY KEY,"
+                " value BLOB NOT NULL,"
+                " expires_at REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS locks ("
+                " key TEXT PRIMARY KEY,"
+                " token TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return (await self.get_many([key])).get(key)
+
+    async def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        return await asyncio.to_thread(self._get_many, keys)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        await self.set_many({key: value}, ttl)
+
+    async def set_many(self, items: Dict[str, bytes], ttl: Optional[float] = None):
+        if items:
+            await asyncio.to_thread(self._set_many, items, ttl)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._delete, key)
+
+    async def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        return await asyncio.to_thread(self._acquire_lock, key, ttl)
+
+    async def release_lock(self, key: str, token: str):
+        await asyncio.to_thread(self._release_lock, key, token)
+
+    async def close(self):
+        await asyncio.to_thread(self._close)
+
+    def _get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        encontrados = {}
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            # SQLite limita el número de parámetros por consulta
+            for i in range(0, len(keys), 500):
+                bloque = keys[i:i + 500]
+                marcadores = ",".join("?" for _ in bloque)
+                filas = conn.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({marcadores})"
+                    " AND (expires_at IS NULL OR expires_at > ?)",
+                    [*bloque, now]
+                ).fetchall()
+                encontrados.update(dict(filas))
+        return encontrados
+
+    def _set_many(self, items: Dict[str, bytes], ttl: Optional[float]):
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                [(key, value, expires_at) for key, value in items.items()]
+            )
+            self._escrituras += 1
+            if self._escrituras % 1000 == 0:
+                conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+
+    def _delete(self, key: str):
+        with self._lock:
+            self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                fila = conn.execute("SELECT expires_at FROM locks WHERE key = ?", (key,)).fetchone()
+                if fila is not None and fila[0] > now:
+                    return None
+                conn.execute(
+                    "INSERT OR REPLACE INTO locks (key, token, expires_at) VALUES (?, ?, ?)",
+                    (key, token, now + ttl)
+                )
+        return token
+
+    def _release_lock(self, key: str, token: str):
+        with self._lock:
+            self._connection().execute("DELETE FROM locks WHERE key = ? AND token = ?", (key, token))
+
+    def _close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class RedisError(Exception):
+    pass
+
+
+RELEASE_LOCK_SCRIPT = (
+    'if redis.call("GET", KEYS[1]) == ARGV[1] then return redis.call("DEL", KEYS[1]) else return 0 end'
+)
+
+
+class RedisBackend(CacheBackend):
+    """
+    Cliente mínimo del protocolo RESP de Redis sobre asyncio (sin dependencias).
+    Usa una conexión por event loop y una petición a la vez por conexión.
+    """
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.db = int(parsed.path.strip("/") or 0)
+        self._conexion = None  # (loop, reader, writer, lock)
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        partes = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, (bytes, bytearray)):
+                arg = str(arg).encode()
+            partes.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(partes)
+
+    async def _leer(self, reader: asyncio.StreamReader):
+        linea = await reader.readline()
+        if not linea:
+            raise ConnectionError("Redis cerró la conexión")
+        tipo, contenido = linea[:1], linea[1:-2]
+        if tipo == b"+":
+            return contenido.decode()
+        if tipo == b"-":
+            raise RedisError(contenido.decode())
+        if tipo == b":":
+            return int(contenido)
+        if tipo == b"$":
+            largo = int(contenido)
+            if largo < 0:
+                return None
+            data = await reader.readexactly(largo + 2)
+            return data[:-2]
+        if tipo == b"*":
+            largo = int(contenido)
+            if largo < 0:
+                return None
+            return [await self._leer(reader) for _ in range(largo)]
+        raise RedisError(f"Respuesta RESP desconocida: {linea!r}")
+
+    async def _abrir(self):
+        loop = asyncio.get_running_loop()
+        if self._conexion is not None:
+            conexion_loop, _, writer, _ = self._conexion
+            if conexion_loop is loop and not writer.is_closing():
+                return self._conexion
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        self._conexion = (loop, reader, writer, asyncio.Lock())
+        if self.password:
+            auth = ("AUTH", self.username, self.password) if self.username else ("AUTH", self.password)
+            await self.command(*auth)
+        if self.db:
+            await self.command("SELECT", self.db)
+        return self._conexion
+
+    async def command(self, *args):
+        _, reader, writer, lock = await self._abrir()
+        async with lock:
+            try:
+                writer.write(self._encode(args))
+                await writer.drain()
+                return await self._leer(reader)
+            except RedisError:
+                # Respuesta de error completa: la conexión sigue sincronizada
+                raise
+            except BaseException:
+                # Cancelado o cortado a mitad del comando: la respuesta quedaría sin leer
+                # y la recibiría el siguiente comando, así que la conexión se descarta
+                writer.close()
+                if self._conexion is not None and self._conexion[2] is writer:
+                    self._conexion = None
+                raise
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.command("GET", key)
+
+    async def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        encontrados = {}
+        for i in range(0, len(keys), 500):
+            bloque = keys[i:i + 500]
+            for key, value in zip(bloque, await self.command("MGET", *bloque)):
+                if value is not None:
+                    encontrados[key] = value
+        return encontrados
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        if ttl is not None:
+            await self.command("SET", key, value, "PX", max(1, int(ttl * 1000)))
+        else:
+            await self.command("SET", key, value)
+
+    async def delete(self, key: str):
+        await self.command("DEL", key)
+
+    async def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        token = uuid.uuid4().hex
+        ok = await self.command("SET", key, token, "NX", "PX", max(1, int(ttl * 1000)))
+        return token if ok == "OK" else None
+
+    async def release_lock(self, key: str, token: str):
+        # Solo se borra si el lock sigue siendo nuestro (pudo vencer y tomarlo otro),
+        # comparando y borrando en una sola operación del servidor
+        await self.command("EVAL", RELEASE_LOCK_SCRIPT, 1, key, token)
+
+    async def close(self):
+        if self._conexion is not None:
+            writer = self._conexion[2]
+            self._conexion = None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+def create_backend(nombre: str = CACHE_BACKEND) -> CacheBackend:
+    if nombre == "memory":
+        return MemoryBackend()
+    if nombre == "sqlite":
+        return SQLiteBackend(CACHE_SQLITE_PATH)
+    if nombre == "redis":
+        return RedisBackend(REDIS_URL)
+    raise ValueError(f"CACHE_BACKEND desconocido: {nombre} (memory, sqlite o redis)")
+
+
+Ttl = Union[None, float, Callable[[Any], Optional[float]]]
+
+
+class SharedCache:
+    """
+    Valores JSON sobre un CacheBackend con "single-flight": si varias peticiones
+    (de este proceso o de otros workers) piden la misma clave ausente, solo una
+    llama a Graph y las demás esperan su resultado.
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def get(self, key: str) -> Any:
+        value = await self.backend.get(key)
+        return loads(value) if value is not None else None
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        return {key: loads(value) for key, value in (await self.backend.get_many(keys)).items()}
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        if ttl is not None and ttl <= 0:
+            return
+        await self.backend.set(key, dumps(value), ttl)
+
+    async def set_many(self, items: Dict[str, Any], ttl: Optional[float] = None):
+        await self.backend.set_many({key: dumps(value) for key, value in items.items()}, ttl)
+
+    async def delete(self, key: str):
+        await self.backend.delete(key)
+
+    @asynccontextmanager
+    async def lock(self, key: str, ttl: float = CACHE_LOCK_WAIT, wait: float = CACHE_LOCK_WAIT):
+        """
+        Lock entre procesos. Si no se consigue en `wait` segundos se sigue sin él
+        (es una optimización, no una garantía): el bloque recibe False en ese caso.
+        """
+        lock_key = f"lock:{key}"
+        limite = time.monotonic() + wait
+        token = await self.backend.acquire_lock(lock_key, ttl)
+        while token is None and time.monotonic() < limite:
+            await asyncio.sleep(CACHE_POLL_INTERVAL)
+            token = await self.backend.acquire_lock(lock_key, ttl)
+        try:
+            yield token is not None
+        finally:
+            if token is not None:
+                await self.backend.release_lock(lock_key, token)
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: Ttl = None) -> Any:
+        """
+        Valor de la caché o, si falta, el resultado de loader(). Se guarda por `ttl`
+        segundos (None: sin vencimiento) o, si ttl es una función, por ttl(valor)
+        segundos (si devuelve None no se guarda).
+        """
+        value = await self.get(key)
+        if value is not None:
+            return value
+
+        # Dentro del proceso: las peticiones simultáneas esperan a la primera
+        pendiente = self._inflight.get(key)
+        if pendiente is not None and pendiente.get_loop() is asyncio.get_running_loop():
+            try:
+                return await asyncio.shield(pendiente)
+            except asyncio.CancelledError:
+                if not pendiente.cancelled():
+                    raise
+                # Se canceló la petición que iba a cargar el valor: lo carga esta
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            # Entre procesos: un lock por clave; quien lo esperó encuentra el valor al entrar
+            async with self.lock(key):
+                value = await self.get(key)
+                if value is None:
+                    value = await loader()
+                    if callable(ttl):
+                        segundos = ttl(value)
+                        if segundos is not None:
+                            await self.set(key, value, segundos)
+                    else:
+                        await self.set(key, value, ttl)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Que no quede el aviso de "excepción nunca leída" si nadie más esperaba
+            future.exception()
+            raise
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+
+cache_backend = create_backend()
+shared_cache = SharedCache(cache_backend)
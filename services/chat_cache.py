@@ -0,0 +1,35 @@
+from typing import Dict, List
+
+from services.cache_backend import SharedCache, shared_cache
+
+
+class ChatCache:
+    """
+    Caché (sender_id, user_id) -> chat_id en el backend compartido (CACHE_BACKEND),
+    así todos los workers reutilizan los mismos chats. El chat oneOnOne entre dos
+    personas siempre es el mismo, así que basta con crearlo una vez.
+    """
+
+    def __init__(self, cache: SharedCache):
+        self._cache = cache
+
+    @staticmethod
+    def _key(sender_id: str, user_id: str) -> str:
+        return f"chat:{sender_id}:{user_id}"
+
+    async def get_many(self, sender_id: str, user_ids: List[str]) -> Dict[str, str]:
+        """Devuelve los chat_id conocidos para los destinatarios indicados"""
+        claves = {self._key(sender_id, user_id): user_id for user_id in user_ids}
+        encontrados = await self._cache.get_many(list(claves))
+        return {claves[key]: chat_id for key, chat_id in encontrados.items()}
+
+    async def set_many(self, sender_id: str, chat_ids: Dict[str, str]):
+        if not chat_ids:
+            return
+        await self._cache.set_many({self._key(sender_id, user_id): chat_id for user_id, chat_id in chat_ids.items()})
+
+    async def invalidate(self, sender_id: str, user_id: str):
+        await self._cache.delete(self._key(sender_id, user_id))
+
+
+chat_cache = ChatCache(shared_cache)
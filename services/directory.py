@@ -0,0 +1,443 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from services.http_client import get_http_client, GRAPH_BASE_URL
+from services.serialization import PrecompressedPayload, dumps
+from services.cache_backend import shared_cache
+from services.identity_cache import token_claims
+
+# Archivo donde se guarda la copia del directorio para arranques en caliente
+DIRECTORY_SNAPSHOT_PATH = os.getenv("DIRECTORY_SNAPSHOT_PATH", "directory_snapshot.json")
+# Cada cuánto se pide a Graph el delta de cambios del directorio (segundos)
+DIRECTORY_REFRESH_SECONDS = float(os.getenv("DIRECTORY_REFRESH_SECONDS", "300"))
+# Tiempo máximo que un worker retiene el lock de sincronización (los demás esperan)
+DIRECTORY_SYNC_LOCK_SECONDS = float(os.getenv("DIRECTORY_SYNC_LOCK_SECONDS", "300"))
+# Tenant (GUID) cuyo directorio se sirve; por defecto el de la app de MSAL. Si
+# MSAL_TENANT_ID es un dominio (itsa.edu.mx), indicar aquí el GUID del tenant
+DIRECTORY_TENANT_ID = (os.getenv("DIRECTORY_TENANT_ID") or os.getenv("MSAL_TENANT_ID") or "").lower()
+
+MATRICULA_RE = re.compile(r"^[0-9]{4}[SDGTK][0-9]{5}$")
+
+CARRERAS = {
+    "S": "Ingenieria en Sistemas Computacionales",
+    "D": "Ingenieria industrial",
+    "G": "Ingenieria en Gestion Empresarial",
+    "T": "Ingenieria en Electromecanica",
+    "K": "Ingenieria en Mecatronica"
+}
+
+
+def determinar_carrera(matricula: str) -> str:
+    letra = matricula[4].upper()
+    return CARRERAS.get(letra, "No encontrada")
+
+
+def letra_de_carrera(carrera: str) -> Optional[str]:
+    """Acepta la letra de la matrícula ("S") o el nombre completo de la carrera"""
+    carrera = carrera.strip()
+    if carrera.upper() in CARRERAS:
+        return carrera.upper()
+    buscado = normalizar(carrera)
+    for letra, nombre in CARRERAS.items():
+        if normalizar(nombre) == buscado:
+            return letra
+    return None
+
+
+def normalizar(texto: str) -> str:
+    """Minúsculas y sin acentos, para comparar nombres"""
+    texto = unicodedata.normalize("NFKD", texto or "")
+    return "".join(c for c in texto if not unicodedata.combining(c)).casefold().strip()
+
+
+def alumno_desde_usuario(user_id: str, user: dict) -> Optional[dict]:
+    """Convierte un usuario de Graph en alumno si su correo tiene formato de matrícula"""
+    mail = user.get("mail")
+    if not mail:
+        return None
+
+    matricula = mail.split("@")[0]
+    if not MATRICULA_RE.match(matricula):
+        return None
+
+    return {
+        "idUser": user_id,
+        "displayName": user.get("displayName"),
+        "mail": mail,
+        "matricula": matricula,
+        "Carrera": determinar_carrera(matricula)
+    }
+
+
+class DirectoryAccessDenied(PermissionError):
+    """El token es de otro tenant: Graph lo acepta, pero no puede leer este directorio"""
+
+
+def check_tenant(token: str):
+    """
+    La copia local es del tenant de ITSA y se sirve a cualquier token que Graph
+    acepte; solo los de ese tenant (claim "tid") pueden leerla. Se llama después
+    de validar el token contra Graph, así que el claim es confiable.
+    """
+    tid = str(token_claims(token).get("tid", "")).lower()
+    if not DIRECTORY_TENANT_ID or tid != DIRECTORY_TENANT_ID:
+        raise DirectoryAccessDenied(f"El token es del tenant {tid or '?'}, no de {DIRECTORY_TENANT_ID or '(sin configurar)'}")
+
+
+class UserDirectory:
+    """
+    Copia local de los usuarios del tenant sincronizada con /users/delta.
+    La primera vez se recorre el directorio completo; después solo se piden
+    los cambios desde el último deltaLink. La lista de alumnos ya filtrada y
+    ordenada se guarda en memoria y en disco.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._usuarios: Dict[str, dict] = {}   # id -> {"displayName", "mail"} de todo el tenant
+        self._delta_link: Optional[str] = None
+        self._synced_at = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._sync_task: Optional[asyncio.Task] = None
+        self._token_provider: Optional[Callable[[], Awaitable[str]]] = None
+        self._app_token_denied = False         # Graph rechazó el token de aplicación (401/403)
+        self._loaded = False
+        self._mtime: Optional[float] = None
+
+        self.usuarios: List[dict] = []         # alumnos ordenados por displayName, con "id"
+        self.etag: Optional[str] = None
+        self._version: Tuple[Optional[str], List[dict]] = (None, [])  # (etag, usuarios) de una sola vez
+        self._listado: Optional[Tuple[str, PrecompressedPayload]] = None
+
+        # Índices sobre self.usuarios (guardan posiciones en la lista ordenada)
+        self._por_carrera: Dict[str, List[int]] = {}
+        self._matriculas: List[Tuple[str, int]] = []
+        self._palabras: List[Tuple[str, int]] = []
+        self._nombres: List[str] = []
+        self._por_id: Dict[str, int] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self._delta_link is not None
+
+    @property
+    def stale(self) -> bool:
+        return time.time() - self._synced_at >= DIRECTORY_REFRESH_SECONDS
+
+    def _load(self):
+        """Carga la copia guardada en disco, si existe"""
+        self._loaded = True
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._mtime = mtime
+        self._usuarios = data.get("usuarios", {})
+        self._delta_link = data.get("delta_link")
+        self._synced_at = data.get("synced_at", 0.0)
+        self._rebuild()
+
+    def _save(self):
+        data = {
+            "delta_link": self._delta_link,
+            "synced_at": self._synced_at,
+            "usuarios": self._usuarios,
+        }
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            print(f"No se pudo guardar el directorio en disco: {e}")
+
+    def _rebuild(self):
+        """Recalcula la lista de alumnos filtrada y ordenada a partir de los usuarios"""
+        alumnos = []
+        for user_id, user in self._usuarios.items():
+            alumno = alumno_desde_usuario(user_id, user)
+            if alumno is not None:
+                alumnos.append(alumno)
+
+        # Ordenar por displayName
+        alumnos.sort(key=lambda x: x["displayName"] or "")
+
+        # Asignar índices después de ordenar
+        for index, alumno in enumerate(alumnos, start=1):
+            alumno["id"] = index
+
+        etag = '"' + hashlib.sha1(dumps(alumnos, sort_keys=True)).hexdigest() + '"'
+        self._version = (etag, alumnos)
+        self.usuarios = alumnos
+        self.etag = etag
+        self._build_indexes()
+
+    def _build_indexes(self):
+        """Índices por carrera, por matrícula (ordenada) y por nombre normalizado"""
+        por_carrera: Dict[str, List[int]] = {}
+        matriculas = []
+        palabras = []
+        nombres = []
+        por_id = {}
+
+        for pos, alumno in enumerate(self.usuarios):
+            por_id[alumno["idUser"]] = pos
+            por_carrera.setdefault(alumno["matricula"][4].upper(), []).append(pos)
+            matriculas.append((alumno["matricula"].upper(), pos))
+
+            nombre = normalizar(alumno["displayName"])
+            nombres.append(nombre)
+            for palabra in set(nombre.split()):
+                palabras.append((palabra, pos))
+
+        matriculas.sort()
+        palabras.sort()
+
+        self._por_carrera = por_carrera
+        self._matriculas = matriculas
+        self._palabras = palabras
+        self._nombres = nombres
+        self._por_id = por_id
+
+    async def listing(self) -> Tuple[str, PrecompressedPayload]:
+        """
+        (etag, listado) del directorio completo {"usuarios": [...]} ya serializado y
+        comprimido. Se arma una vez por versión (en un hilo) y se reutiliza en cada
+        lectura. El etag es el de los bytes devueltos: si el directorio cambia
+        mientras se serializa, la respuesta sigue siendo coherente.
+        """
+        listado = self._listado
+        etag, usuarios = self._version
+        if listado is None or listado[0] != etag:
+            listado = (etag, await asyncio.to_thread(PrecompressedPayload, {"usuarios": usuarios}))
+            self._listado = listado
+        return listado
+
+    def get_by_id(self, user_id: str) -> Optional[dict]:
+        pos = self._por_id.get(user_id)
+        return self.usuarios[pos] if pos is not None else None
+
+    @staticmethod
+    def _rango_por_prefijo(indice: List[Tuple[str, int]], prefijo: str) -> set:
+        inicio = bisect.bisect_left(indice, (prefijo,))
+        fin = bisect.bisect_left(indice, (prefijo + "\uffff",))
+        return {pos for _, pos in indice[inicio:fin]}
+
+    def query(self, carrera: Optional[str] = None, matricula_prefix: Optional[str] = None,
+              q: Optional[str] = None, modo: str = "prefix", offset: int = 0, limit: Optional[int] = None):
+        """
+        Filtra los alumnos usando los índices y devuelve (total, página).
+        - carrera: letra de la matrícula ("S") o nombre de la carrera
+        - matricula_prefix: inicio de la matrícula, p.ej. el año de ingreso "2021"
+        - q: texto a buscar en el nombre; modo "prefix" (inicio de alguna palabra)
+          o "substring" (en cualquier parte del nombre)
+        El resultado conserva el orden por displayName.
+        """
+        candidatos: Optional[set] = None
+
+        def intersectar(posiciones):
+            nonlocal candidatos
+            candidatos = set(posiciones) if candidatos is None else candidatos & set(posiciones)
+
+        if carrera:
+            letra = letra_de_carrera(carrera)
+            intersectar(self._por_carrera.get(letra, []) if letra else [])
+
+        if matricula_prefix:
+            intersectar(self._rango_por_prefijo(self._matriculas, matricula_prefix.strip().upper()))
+
+        if q:
+            buscado = normalizar(q)
+            if modo == "substring":
+                base = candidatos if candidatos is not None else range(len(self._nombres))
+                intersectar(pos for pos in base if buscado in self._nombres[pos])
+            else:
+                # Todas las palabras buscadas deben ser inicio de alguna palabra del nombre
+                for palabra in buscado.split():
+                    intersectar(self._rango_por_prefijo(self._palabras, palabra))
+
+        if candidatos is None:
+            posiciones = range(len(self.usuarios))
+        else:
+            posiciones = sorted(candidatos)
+
+        total = len(posiciones)
+        fin = total if limit is None else offset + limit
+        return total, [self.usuarios[pos] for pos in posiciones[offset:fin]]
+
+    async def _sync(self, token: str):
+        """Aplica los cambios de /users/delta (o un recorrido completo si no hay deltaLink)"""
+        client = get_http_client()
+        headers = {"Authorization": f"Bearer {token}"}
+        next_link = self._delta_link or f"{GRAPH_BASE_URL}/users/delta?$select=id,displayName,mail,userPrincipalName"
+        full_sync = self._delta_link is None
+        usuarios = {} if full_sync else dict(self._usuarios)
+
+        while next_link:
+            response = await client.get(next_link, headers=headers)
+            if response.status_code == 410 and not full_sync:
+                # El deltaLink caducó: hay que volver a sincronizar desde cero
+                self._delta_link = None
+                return await self._sync(token)
+            response.raise_for_status()
+            data = response.json()
+
+            for user in data.get("value", []):
+                user_id = user["id"]
+                if "@removed" in user:
+                    usuarios.pop(user_id, None)
+                    continue
+                # En los cambios incrementales Graph solo manda las propiedades modificadas
+                actual = dict(usuarios.get(user_id, {}))
+                for campo in ("displayName", "mail"):
+                    if campo in user:
+                        actual[campo] = user[campo]
+                usuarios[user_id] = actual
+
+            next_link = data.get("@odata.nextLink")
+            if not next_link:
+                self._delta_link = data.get("@odata.deltaLink")
+
+        self._usuarios = usuarios
+        self._synced_at = time.time()
+        self._rebuild()
+        self._save()
+
+    def _reload_if_changed(self):
+        """Vuelve a leer la copia en disco si otro worker la actualizó"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self._load()
+
+    async def refresh(self, token: str, force: bool = False):
+        """
+        Sincroniza con Graph si la copia está vencida (o si se fuerza). Entre workers
+        sincroniza uno solo: los demás esperan el lock y leen la copia que dejó en disco.
+        """
+        async with self._lock:
+            if not self._loaded:
+                self._load()
+            if not (force or not self.ready or self.stale):
+                return
+
+            synced_at = self._synced_at
+            async with shared_cache.lock("directory:sync", ttl=DIRECTORY_SYNC_LOCK_SECONDS, wait=DIRECTORY_SYNC_LOCK_SECONDS):
+                self._reload_if_changed()
+                # Si otro worker sincronizó mientras se esperaba el lock, basta con su copia
+                otro_worker = self._synced_at != synced_at and self.ready
+                if not otro_worker and (force or not self.ready or self.stale):
+                    await self._sync(token)
+            # La nueva versión del listado se prepara aquí y no en la próxima petición
+            await self.listing()
+
+    async def warm_up(self):
+        """Carga la copia en disco y arma el listado antes de la primera petición"""
+        async with self._lock:
+            if not self._loaded:
+                await asyncio.to_thread(self._load)
+        if self.ready:
+            await self.listing()
+
+    async def _token_de_sync(self, token: str) -> str:
+        """Token de aplicación si hay sincronización en segundo plano; si no, el del usuario"""
+        if self._token_provider is not None and not self._app_token_denied:
+            try:
+                return await self._token_provider()
+            except Exception as e:
+                print(f"No se pudo obtener el token de aplicación, se usa el del usuario: {e}")
+        return token
+
+    async def _refresh_con(self, token: str):
+        """
+        Sincroniza con el token de aplicación si lo hay. Si Graph lo rechaza (p.ej. la
+        app no tiene el permiso de aplicación User.Read.All) se usa el del usuario.
+        """
+        token_sync = await self._token_de_sync(token)
+        try:
+            await self.refresh(token_sync)
+        except httpx.HTTPStatusError as e:
+            if token_sync == token or e.response.status_code not in (401, 403):
+                raise
+            self._app_token_denied = True
+            print(f"Graph rechazó el token de aplicación ({e.response.status_code}): ¿falta el permiso "
+                  f"User.Read.All con consentimiento de admin? Se sincroniza con el token del usuario")
+            await self.refresh(token)
+
+    def _refresh_in_background(self, token: str):
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+
+        async def tarea():
+            try:
+                await self._refresh_con(token)
+            except httpx.HTTPError as e:
+                print(f"Error al actualizar el directorio: {e}")
+
+        self._refresh_task = asyncio.create_task(tarea())
+
+    def start_background_sync(self, token_provider: Callable[[], Awaitable[str]]):
+        """
+        Mantiene el directorio al día cada DIRECTORY_REFRESH_SECONDS con un token que no
+        depende de la sesión de nadie (p.ej. el de aplicación), fuera de las peticiones.
+        """
+        self._token_provider = token_provider
+
+        async def bucle():
+            while True:
+                try:
+                    synced_at = self._synced_at
+                    await self.refresh(await token_provider())
+                    if self._synced_at != synced_at:
+                        # Graph aceptó el token de aplicación: las peticiones vuelven a usarlo
+                        self._app_token_denied = False
+                except Exception as e:
+                    print(f"Error en la sincronización del directorio: {e}")
+                await asyncio.sleep(DIRECTORY_REFRESH_SECONDS)
+
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(bucle())
+
+    async def stop_background_sync(self):
+        self._token_provider = None
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+
+    async def get(self, token: str) -> "UserDirectory":
+        """
+        Devuelve el directorio listo para leer. Solo espera a Graph si todavía
+        no hay copia; si la copia está vencida se actualiza en segundo plano.
+        """
+        if not self._loaded:
+            async with self._lock:
+                if not self._loaded:
+                    self._load()
+
+        if not self.ready:
+            await self._refresh_con(token)
+        elif self.stale:
+            self._refresh_in_background(token)
+        return self
+
+
+directory = UserDirectory(DIRECTORY_SNAPSHOT_PATH)
@@ -0,0 +1,77 @@
+import json
+from typing import Dict, List, Optional, Union
+
+import httpx
+
+from services.http_client import GRAPH_BASE_URL
+from services.throttle import is_message_post
+
+# Graph acepta como máximo 20 sub-peticiones por cada llamada a $batch
+MAX_BATCH_SIZE = 20
+
+
+def batch_request(request_id: str, method: str, url: str, body: Optional[Union[dict, bytes]] = None, depends_on: Optional[List[str]] = None) -> dict:
+    """
+    Construye una sub-petición del sobre JSON de $batch (url relativa, p.ej. "/chats").
+    El body puede ser un dict o bytes con JSON ya serializado, que se insertan tal cual.
+    """
+    request = {
+        "id": request_id,
+        "method": method,
+        "url": url,
+    }
+    if body is not None:
+        request["headers"] = {"Content-Type": "application/json"}
+        request["body"] = body
+    if depends_on:
+        request["dependsOn"] = depends_on
+    return request
+
+
+def _serializar(request: dict) -> bytes:
+    body = request.get("body")
+    if not isinstance(body, (bytes, bytearray)):
+        return json.dumps(request, ensure_ascii=False).encode()
+    # El cuerpo ya viene serializado: se pega al resto de la sub-petición sin volver a codificarlo
+    resto = json.dumps({k: v for k, v in request.items() if k != "body"}, ensure_ascii=False).encode()
+    return resto[:-1] + b',"body":' + bytes(body) + b"}"
+
+
+async def execute_batch(client: httpx.AsyncClient, headers: dict, requests: List[dict]) -> Dict[str, dict]:
+    """
+    Envía hasta 20 sub-peticiones en una sola llamada POST /$batch y devuelve
+    las respuestas indexadas por el "id" de cada sub-petición.
+    """
+    if len(requests) > MAX_BATCH_SIZE:
+        raise ValueError(f"Un $batch admite como máximo {MAX_BATCH_SIZE} peticiones")
+
+    response = await client.post(
+        f"{GRAPH_BASE_URL}/$batch",
+        headers={**headers, "Content-Type": "application/json"},
+        content=b'{"requests":[' + b",".join(_serializar(request) for request in requests) + b"]}",
+        # El control de ritmo (services.throttle) cuenta cada sub-petición y cada mensaje
+        extensions={
+            "graph_requests": len(requests),
+            "graph_messages": sum(is_message_post(r["method"], r["url"]) for r in requests)
+        }
+    )
+    response.raise_for_status()
+
+    responses = {}
+    for item in response.json().get("responses", []):
+        responses[str(item.get("id"))] = item
+    return responses
+
+
+def is_success(response: Optional[dict]) -> bool:
+    return response is not None and 200 <= int(response.get("status", 0)) < 300
+
+
+def describe_error(response: Optional[dict]) -> str:
+    """Texto de error con el mismo formato que usa GraphService para httpx.HTTPStatusError"""
+    if response is None:
+        return "HTTP Error 0: sin respuesta en el $batch"
+    body = response.get("body")
+    if not isinstance(body, str):
+        body = json.dumps(body)
+    return f"HTTP Error {response.get('status')}: {body}"
@@ -1,57 +1,422 @@
+import asyncio
+import io
+import os
 import httpx
-import re
 import json
 import uuid
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+from services.http_client import get_http_client, GRAPH_BASE_URL
+from services.graph_batch import MAX_BATCH_SIZE, batch_request, execute_batch, is_success, describe_error
+from services.chat_cache import chat_cache
+from services.identity_cache import identity_cache
+from services.directory import directory, alumno_desde_usuario, check_tenant
+from services.upload import upload_in_chunks
+from services.attachment_cache import attachment_cache, content_hash
+from services.payloads import compile_text_template, serializar
+from services.group_chats import GROUP_CHAT_MAX_MEMBERS, group_chat_store
+from services.metrics import GRAPH_MESSAGES_TOTAL, GRAPH_OPERATION_SECONDS, GRAPH_RETRIES_TOTAL, GRAPH_THROTTLED_TOTAL
+from services.throttle import (
+    GRAPH_MAX_RETRIES, THROTTLED_STATUS, backoff, rate_governor, retry_after, retryable_status
+)
+
+# Número máximo de destinatarios (o lotes de $batch) atendidos en paralelo por envío
+GRAPH_SEND_CONCURRENCY = int(os.getenv("GRAPH_SEND_CONCURRENCY", "10"))
+# Agrupar la creación de chats y el envío de mensajes en llamadas a $batch
+GRAPH_USE_BATCH = os.getenv("GRAPH_USE_BATCH", "true").lower() in ("1", "true", "yes")
+# Tiempo máximo (segundos) que se espera la miniatura de un adjunto antes de enviar sin ella
+THUMBNAIL_WAIT_SECONDS = float(os.getenv("THUMBNAIL_WAIT_SECONDS", "1.5"))
 
 class GraphService:
     
+    async def get_user_directory(self, token: str):
+        """Directorio de alumnos sincronizado con /users/delta"""
+        # Validar el token (la identidad queda en caché) y su tenant antes de servir la copia local
+        await self.get_me(token)
+        check_tenant(token)
+        with GRAPH_OPERATION_SECONDS.time(operation="directory"):
+            return await directory.get(token)
+
     async def get_all_users(self, token: str):
-        usuarios_filtrados = []
-        next_link = "https://graph.microsoft.com/v1.0/users?$select=id,displayName,mail,userPrincipalName"
-
-        def determinar_carrera(matricula: str) -> str:
-            letra = matricula[4].upper()
-            return {
-                "S": "Ingenieria en Sistemas Computacionales",
-                "D": "Ingenieria industrial",
-                "G": "Ingenieria en Gestion Empresarial",
-                "T": "Ingenieria en Electromecanica",
-                "K": "Ingenieria en Mecatronica"
-            }.get(letra, "No encontrada")
-        
-        async with httpx.AsyncClient() as client:
-            while next_link:
-                headers = {"Authorization": f"Bearer {token}"}
-                response = await client.get(next_link, headers=headers)
-                response.raise_for_status()
-                data = response.json()
-
-                for user in data.get("value", []):
-                    mail = user.get("mail")
-                            
-                    if not mail:
-                        continue
-                    
-                    matricula = mail.split("@")[0]
-                    if re.match(r"^[0-9]{4}[SDGTK][0-9]{5}$", matricula):                        
-                        usuarios_filtrados.append({
-                            "idUser": user["id"],
-                            "displayName": user["displayName"],
-                            "mail": mail,
-                            "matricula": matricula,
-                            "Carrera": determinar_carrera(matricula)
-                        })
-
-                next_link = data.get("@odata.nextLink")
-
-        # Ordenar por displayName
-        usuarios_filtrados.sort(key=lambda x: x["displayName"])
-
-        # Asignar índices después de ordenar
-        for index, usuario in enumerate(usuarios_filtrados, start=1):
-            usuario["id"] = index
-
-        return {"usuarios": usuarios_filtrados}
+        snapshot = await self.get_user_directory(token)
+        return {"usuarios": snapshot.usuarios}
+
+    async def resolve_audience(self, token: str, user_ids: Optional[List[str]] = None,
+                               carrera: Optional[str] = None, matricula_prefix: Optional[str] = None) -> List[str]:
+        """
+        Lista de destinatarios: los ids indicados más los alumnos del directorio que
+        cumplan los selectores (carrera y/o prefijo de matrícula, p.ej. "2021").
+        """
+        destinatarios = list(user_ids or [])
+        if carrera or matricula_prefix:
+            snapshot = await self.get_user_directory(token)
+            _, alumnos = snapshot.query(carrera=carrera, matricula_prefix=matricula_prefix)
+            destinatarios.extend(alumno["idUser"] for alumno in alumnos)
+        # Sin duplicados y conservando el orden
+        return list(dict.fromkeys(destinatarios))
+
+    async def stream_users(self, token: str):
+        """
+        Recorre las páginas de /users y entrega los alumnos de cada página en
+        cuanto llega, sin juntar todo el tenant en memoria ni ordenar.
+        """
+        client = get_http_client()
+        headers = {"Authorization": f"Bearer {token}"}
+        next_link = f"{GRAPH_BASE_URL}/users?$select=id,displayName,mail,userPrincipalName"
+
+        while next_link:
+            response = await client.get(next_link, headers=headers)
+            response.raise_for_status()
+            data = response.json()
+
+            alumnos = []
+            for user in data.get("value", []):
+                alumno = alumno_desde_usuario(user["id"], user)
+                if alumno is not None:
+                    alumnos.append(alumno)
+            if alumnos:
+                yield alumnos
+
+            next_link = data.get("@odata.nextLink")
+
+    async def get_me(self, token: str) -> dict:
+        """
+        Perfil de quien envía (GET /me), guardado en la caché compartida mientras el
+        token siga vigente. Si llegan varias peticiones con el mismo token a la vez,
+        solo una consulta a Graph.
+        """
+        async def cargar():
+            client = get_http_client()
+            response = await client.get(
+                f"{GRAPH_BASE_URL}/me",
+                headers={"Authorization": f"Bearer {token}"}
+            )
+            response.raise_for_status()
+            return response.json()
+
+        return await identity_cache.get_or_load(token, cargar)
+
+    @staticmethod
+    def _miembro(user_id: str) -> dict:
+        return {
+            "@odata.type": "#microsoft.graph.aadUserConversationMember",
+            "roles": ["owner"],
+            "user@odata.bind": f"https://graph.microsoft.com/v1.0/users/{user_id}"
+        }
+
+    @staticmethod
+    def _chat_body(sender_id: str, user_id: str) -> dict:
+        """Cuerpo para crear el chat 1 a 1 entre quien envía y el destinatario"""
+        return {
+            "chatType": "oneOnOne",
+            "members": [GraphService._miembro(sender_id), GraphService._miembro(user_id)]
+        }
+
+    @staticmethod
+    def _group_chat_body(sender_id: str, user_ids: List[str], topic: str) -> dict:
+        """Cuerpo para crear un chat grupal de quien envía con varios alumnos"""
+        return {
+            "chatType": "group",
+            "topic": topic,
+            "members": [GraphService._miembro(sender_id)] + [GraphService._miembro(user_id) for user_id in user_ids]
+        }
+
+    async def _ejecutar(self, client: httpx.AsyncClient, headers: dict, operaciones: list):
+        """
+        Ejecuta una lista de operaciones (method, url relativa, body) contra Graph y
+        devuelve, en el mismo orden, respuestas con el formato de $batch:
+        {"status": ..., "body": ...}. Con GRAPH_USE_BATCH se agrupan de 20 en 20;
+        si no, se hace una petición por operación. En ambos casos en paralelo.
+        """
+        semaforo = asyncio.Semaphore(GRAPH_SEND_CONCURRENCY)
+
+        async def ejecutar_grupo(grupo: list):
+            async with semaforo:
+                try:
+                    if len(grupo) == 1:
+                        method, url, body = grupo[0]
+                        if isinstance(body, (bytes, bytearray)):
+                            response = await client.request(method, f"{GRAPH_BASE_URL}{url}", headers=headers, content=body)
+                        else:
+                            response = await client.request(method, f"{GRAPH_BASE_URL}{url}", headers=headers, json=body)
+                        try:
+                            response_body = response.json()
+                        except ValueError:
+                            response_body = response.text
+                        return [{"status": response.status_code, "body": response_body}]
+
+                    # Las sub-peticiones limitadas (429/503, y 504 en GET) se reintentan en otro $batch;
+                    # un POST con 504 pudo haberse procesado y queda como error del destinatario
+                    respuestas = [None] * len(grupo)
+                    pendientes = list(range(len(grupo)))
+                    for intento in range(GRAPH_MAX_RETRIES + 1):
+                        requests = [batch_request(str(i), *grupo[i]) for i in pendientes]
+                        responses = await execute_batch(client, headers, requests)
+
+                        reintentar = []
+                        espera = None
+                        for i in pendientes:
+                            respuesta = responses.get(str(i)) or {"status": 0, "body": "sin respuesta en el $batch"}
+                            respuestas[i] = respuesta
+                            if respuesta.get("status") in THROTTLED_STATUS:
+                                GRAPH_THROTTLED_TOTAL.inc(operation="batch_item", status=respuesta.get("status"))
+                            if retryable_status(grupo[i][0], respuesta.get("status", 0)) and intento < GRAPH_MAX_RETRIES:
+                                GRAPH_RETRIES_TOTAL.inc(operation="batch_item", reason=respuesta.get("status"))
+                                reintentar.append(i)
+                                segundos = retry_after(respuesta.get("headers") or {})
+                                if segundos is not None:
+                                    espera = max(espera or 0, segundos)
+                                if respuesta.get("status") in THROTTLED_STATUS:
+                                    rate_governor.throttled(headers.get("Authorization"), segundos)
+
+                        if not reintentar:
+                            break
+                        await asyncio.sleep(espera if espera is not None else backoff(intento))
+                        pendientes = reintentar
+                    return respuestas
+                except httpx.HTTPStatusError as e:
+                    return [{"status": e.response.status_code, "body": e.response.text}] * len(grupo)
+                except Exception as e:
+                    return [{"status": 0, "body": str(e)}] * len(grupo)
+
+        tamaño = MAX_BATCH_SIZE if GRAPH_USE_BATCH else 1
+        grupos = [operaciones[i:i + tamaño] for i in range(0, len(operaciones), tamaño)]
+        respuestas = await asyncio.gather(*(ejecutar_grupo(grupo) for grupo in grupos))
+        return [respuesta for grupo in respuestas for respuesta in grupo]
+
+    async def _entregar(self, client: httpx.AsyncClient, headers: dict, sender_id: str, user_ids: list, message_body):
+        """
+        Entrega un mensaje a varios destinatarios. Devuelve un resultado por
+        destinatario, en el mismo orden, con "status" igual a "success" o "error".
+
+        message_body puede ser un dict, un MessageTemplate o bytes (se serializa una
+        sola vez para todos), o una función user_id -> bytes si cambia por destinatario.
+
+        Los chats ya conocidos se toman de chat_cache y solo se crean los que faltan.
+        Si un chat guardado responde 403/404, se descarta y se vuelve a crear.
+        """
+        resultados = {}
+
+        if callable(message_body):
+            cuerpo_de = message_body
+        else:
+            cuerpo = serializar(message_body)
+            cuerpo_de = lambda user_id: cuerpo
+
+        def registrar(user_id: str, chat_id: str, respuesta: dict):
+            if is_success(respuesta):
+                resultados[user_id] = {
+                    "user_id": user_id,
+                    "chat_id": chat_id,
+                    "message_id": respuesta["body"].get("id"),
+                    "status": "success",
+                    "message": respuesta["body"]
+                }
+            else:
+                resultados[user_id] = {
+                    "user_id": user_id,
+                    "chat_id": chat_id,
+                    "status": "error",
+                    "error": describe_error(respuesta)
+                }
+
+        # 1. Publicar directamente en los chats que ya tenemos guardados
+        conocidos = await chat_cache.get_many(sender_id, list(dict.fromkeys(user_ids)))
+        pendientes = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in conocidos]
+
+        if conocidos:
+            destinos = list(conocidos.items())
+            respuestas = await self._ejecutar(client, headers, [
+                ("POST", f"/chats/{chat_id}/messages", cuerpo_de(user_id)) for user_id, chat_id in destinos
+            ])
+            for (user_id, chat_id), respuesta in zip(destinos, respuestas):
+                if respuesta.get("status") in (403, 404):
+                    await chat_cache.invalidate(sender_id, user_id)
+                    pendientes.append(user_id)
+                else:
+                    registrar(user_id, chat_id, respuesta)
+
+        # 2. Crear los chats que faltan y publicar en ellos
+        if pendientes:
+            respuestas = await self._ejecutar(client, headers, [
+                ("POST", "/chats", self._chat_body(sender_id, user_id)) for user_id in pendientes
+            ])
+            creados = {}
+            for user_id, respuesta in zip(pendientes, respuestas):
+                if is_success(respuesta):
+                    creados[user_id] = respuesta["body"]["id"]
+                else:
+                    resultados[user_id] = {
+                        "user_id": user_id,
+                        "status": "error",
+                        "error": describe_error(respuesta)
+                    }
+            await chat_cache.set_many(sender_id, creados)
+
+            destinos = list(creados.items())
+            respuestas = await self._ejecutar(client, headers, [
+                ("POST", f"/chats/{chat_id}/messages", cuerpo_de(user_id)) for user_id, chat_id in destinos
+            ])
+            for (user_id, chat_id), respuesta in zip(destinos, respuestas):
+                registrar(user_id, chat_id, respuesta)
+
+        return [resultados[user_id] for user_id in user_ids]
+
+    async def _miembros_actuales(self, client: httpx.AsyncClient, headers: dict, chat_id: str) -> Dict[str, str]:
+        """userId -> id de la membresía, necesario para sacar a alguien del chat"""
+        membresias = {}
+        next_link = f"{GRAPH_BASE_URL}/chats/{chat_id}/members"
+        while next_link:
+            response = await client.get(next_link, headers=headers)
+            response.raise_for_status()
+            data = response.json()
+            for miembro in data.get("value", []):
+                if miembro.get("userId"):
+                    membresias[miembro["userId"]] = miembro["id"]
+            next_link = data.get("@odata.nextLink")
+        return membresias
+
+    async def _sincronizar_miembros(self, client: httpx.AsyncClient, headers: dict, chat_id: str,
+                                    actuales: Set[str], deseados: Set[str]) -> Tuple[Set[str], Dict[str, str]]:
+        """
+        Agrega y quita miembros del chat grupal según la diferencia con la audiencia.
+        Devuelve los miembros que quedan en el chat y los errores de quien no se pudo agregar.
+        """
+        nuevos = sorted(deseados - actuales)
+        salientes = sorted(actuales - deseados)
+        miembros = set(actuales)
+        errores = {}
+
+        # Primero se quita a quien ya no pertenece, para no pasar del límite de miembros al agregar
+        if salientes:
+            membresias = await self._miembros_actuales(client, headers, chat_id)
+            quitados = [user_id for user_id in salientes if user_id in membresias]
+            # Los que ya no estaban en el chat (p.ej. salieron por su cuenta) se olvidan sin más
+            miembros -= set(salientes) - set(quitados)
+            respuestas = await self._ejecutar(client, headers, [
+                ("DELETE", f"/chats/{chat_id}/members/{membresias[user_id]}", None) for user_id in quitados
+            ]) if quitados else []
+            for user_id, respuesta in zip(quitados, respuestas):
+                if is_success(respuesta) or respuesta.get("status") == 404:
+                    miembros.discard(user_id)
+
+        if nuevos:
+            respuestas = await self._ejecutar(client, headers, [
+                ("POST", f"/chats/{chat_id}/members", {
+                    **self._miembro(user_id),
+                    "visibleHistoryStartDateTime": "0001-01-01T00:00:00Z"
+                })
+                for user_id in nuevos
+            ])
+            for user_id, respuesta in zip(nuevos, respuestas):
+                if is_success(respuesta):
+                    miembros.add(user_id)
+                else:
+                    errores[user_id] = describe_error(respuesta)
+        return miembros, errores
+
+    async def _entregar_en_grupo(self, client: httpx.AsyncClient, headers: dict, sender_id: str, user_ids: list,
+                                 message_body, audience_key: str, topic: str):
+        """
+        Entrega el mensaje publicándolo una vez en el chat grupal de la audiencia en lugar
+        de un chat 1 a 1 por alumno. Los chats se guardan en group_chat_store y en cada
+        envío solo se agregan o quitan los miembros que cambiaron en el directorio.
+        Devuelve un resultado por destinatario, igual que _entregar().
+        """
+        cuerpo = serializar(message_body)
+        capacidad = GROUP_CHAT_MAX_MEMBERS - 1
+        deseados = [user_id for user_id in dict.fromkeys(user_ids) if user_id != sender_id]
+        pendientes = set(deseados)
+        resultados = {}
+
+        # Cada alumno se queda en la parte donde ya estaba; los nuevos llenan los huecos
+        guardadas = group_chat_store.get(sender_id, audience_key)
+        asignacion: Dict[int, Set[str]] = {}
+        for part, (_, miembros) in guardadas.items():
+            asignacion[part] = miembros & pendientes
+            pendientes -= asignacion[part]
+        for user_id in deseados:
+            if user_id not in pendientes:
+                continue
+            part = next((p for p in sorted(asignacion) if len(asignacion[p]) < capacidad), None)
+            if part is None:
+                part = max(asignacion, default=-1) + 1
+                asignacion[part] = set()
+            asignacion[part].add(user_id)
+            pendientes.discard(user_id)
+
+        async def entregar_parte(part: int, miembros: Set[str]):
+            errores = {}
+            chat_id = None
+            respuesta = None
+
+            if part in guardadas:
+                chat_id, actuales = guardadas[part]
+                try:
+                    presentes, errores = await self._sincronizar_miembros(client, headers, chat_id, actuales, miembros)
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code not in (403, 404):
+                        raise
+                    presentes = None
+                if presentes is not None:
+                    group_chat_store.save(sender_id, audience_key, part, chat_id, presentes)
+                    respuesta = (await self._ejecutar(client, headers, [
+                        ("POST", f"/chats/{chat_id}/messages", cuerpo)
+                    ]))[0]
+                if presentes is None or respuesta.get("status") in (403, 404):
+                    # El chat ya no existe o quien envía ya no pertenece a él: se crea otro
+                    group_chat_store.invalidate(sender_id, audience_key, part)
+                    chat_id = None
+                    errores = {}
+
+            if chat_id is None:
+                titulo = topic if len(asignacion) == 1 else f"{topic} ({part + 1})"
+                creado = (await self._ejecutar(client, headers, [
+                    ("POST", "/chats", self._group_chat_body(sender_id, sorted(miembros), titulo))
+                ]))[0]
+                if not is_success(creado):
+                    for user_id in miembros:
+                        resultados[user_id] = {
+                            "user_id": user_id,
+                            "status": "error",
+                            "error": describe_error(creado)
+                        }
+                    return
+                chat_id = creado["body"]["id"]
+                group_chat_store.save(sender_id, audience_key, part, chat_id, miembros)
+                respuesta = (await self._ejecutar(client, headers, [
+                    ("POST", f"/chats/{chat_id}/messages", cuerpo)
+                ]))[0]
+
+            for user_id in miembros:
+                if user_id in errores:
+                    resultados[user_id] = {"user_id": user_id, "chat_id": chat_id, "status": "error", "error": errores[user_id]}
+                elif is_success(respuesta):
+                    resultados[user_id] = {
+                        "user_id": user_id,
+                        "chat_id": chat_id,
+                        "message_id": respuesta["body"].get("id"),
+                        "status": "success",
+                        "message": respuesta["body"]
+                    }
+                else:
+                    resultados[user_id] = {"user_id": user_id, "chat_id": chat_id, "status": "error", "error": describe_error(respuesta)}
+
+        async def entregar_parte_aislada(part: int, miembros: Set[str]):
+            try:
+                await entregar_parte(part, miembros)
+            except Exception as e:
+                error = f"HTTP Error {e.response.status_code}: {e.response.text}" if isinstance(e, httpx.HTTPStatusError) else str(e)
+                for user_id in miembros:
+                    resultados[user_id] = {"user_id": user_id, "status": "error", "error": error}
+
+        await asyncio.gather(*(
+            entregar_parte_aislada(part, miembros) for part, miembros in asignacion.items() if miembros
+        ))
+        return [
+            resultados.get(user_id) or {"user_id": user_id, "status": "error", "error": "Quien envía no puede ser destinatario de su propio chat grupal"}
+            for user_id in user_ids
+        ]
 
     async def send_message_to_user(self, token: str, user_id: str, content: str):
         headers = {
@@ -61,58 +426,21 @@ class GraphService:
 
         try:
             # 1. Obtener el ID del usuario autenticado (quien envía el mensaje)
-            async with httpx.AsyncClient() as client:
-                me_response = await client.get(
-                    "https://graph.microsoft.com/v1.0/me",
-                    headers=headers
-                )
-                me_response.raise_for_status()
-                me_data = me_response.json()
-                sender_id = me_data["id"]
-            
-            # 2. Crear chat con ambos miembros
-            chat_body = {
-                "chatType": "oneOnOne",
-                "members": [
-                    {
-                        "@odata.type": "#microsoft.graph.aadUserConversationMember",
-                        "roles": ["owner"],
-                        "user@odata.bind": f"https://graph.microsoft.com/v1.0/users/{sender_id}"
-                    },
-                    {
-                        "@odata.type": "#microsoft.graph.aadUserConversationMember",
-                        "roles": ["owner"],
-                        "user@odata.bind": f"https://graph.microsoft.com/v1.0/users/{user_id}"
-                    }
-                ]
-            }
-
-            async with httpx.AsyncClient() as client:
-                chat_response = await client.post(
-                    "https://graph.microsoft.com/v1.0/chats",
-                    headers=headers,
-                    json=chat_body
-                )
-
-                chat_response.raise_for_status()
-                chat_data = chat_response.json()
-                chat_id = chat_data["id"]
-         
-                # 3. Enviar mensaje
-                message_body = {
-                    "body": {
-                        "contentType": "text",
-                        "content": content
-                    }
+            client = get_http_client()
+            sender_id = (await self.get_me(token))["id"]
+
+            # 2. Crear chat con ambos miembros y enviar mensaje
+            message_body = {
+                "body": {
+                    "contentType": "text",
+                    "content": content
                 }
+            }
 
-                message_response = await client.post(
-                    f"https://graph.microsoft.com/v1.0/chats/{chat_id}/messages",
-                    headers=headers,
-                    json=message_body
-                )
-                message_response.raise_for_status()
-                return message_response.json()
+            result = (await self._entregar(client, headers, sender_id, [user_id], message_body))[0]
+            if result["status"] != "success":
+                raise Exception(result["error"])
+            return result["message"]
 
         except httpx.HTTPStatusError as e:
             error_detail = f"HTTP Error {e.response.status_code}: {e.response.text}"
@@ -122,140 +450,261 @@ class GraphService:
 
 
 
-    async def send_message_with_attachment(self, token: str, user_ids: list, content: str, file_bytes: bytes, file_name: str):
+    async def send_bulk_message(self, token: str, user_ids: list, template: str, group: Optional[Tuple[str, str]] = None):
+        """
+        Envía un texto personalizado a varios destinatarios. La plantilla se compila
+        una vez y se rellena con los datos del directorio de cada alumno
+        ({displayName}, {mail}, {matricula}, {Carrera}).
+
+        Con group=(audience_key, topic) se publica una sola vez en el chat grupal de la
+        audiencia, así que la plantilla no puede llevar marcadores.
+        """
+        plantilla = compile_text_template(template)
+        if group is not None and plantilla.slots:
+            raise ValueError("Los mensajes a un chat grupal no admiten marcadores por alumno")
+
+        try:
+            sender_id = (await self.get_me(token))["id"]
+            snapshot = await self.get_user_directory(token) if plantilla.slots else None
+
+            # Con marcadores, un destinatario que no está en el directorio recibiría el
+            # mensaje con huecos vacíos ("Hola !"): no se le envía y queda como error
+            faltantes = set()
+            if snapshot is not None:
+                faltantes = {user_id for user_id in user_ids if snapshot.get_by_id(user_id) is None}
+            destinatarios = [user_id for user_id in user_ids if user_id not in faltantes]
+
+            def cuerpo_de(user_id: str) -> bytes:
+                datos = snapshot.get_by_id(user_id) if snapshot is not None else None
+                return plantilla.render(datos)
+
+            enviados = iter(await self.deliver(token, sender_id, destinatarios, plantilla if group else cuerpo_de, group=group)
+                            if destinatarios else [])
+            results = []
+            for user_id in user_ids:
+                if user_id in faltantes:
+                    results.append({
+                        "user_id": user_id,
+                        "status": "error",
+                        "error": "Destinatario no encontrado en el directorio: no se puede personalizar el mensaje"
+                    })
+                else:
+                    result = next(enviados)
+                    result.pop("message", None)
+                    results.append(result)
+            return results
+
+        except httpx.HTTPStatusError as e:
+            raise Exception(f"HTTP Error {e.response.status_code}: {e.response.text}")
+
+    async def send_message_with_attachment(self, token: str, user_ids: list, content: str, file_bytes: bytes, file_name: str, on_progress=None, group: Optional[Tuple[str, str]] = None):
+        return await self.send_message_with_file(
+            token=token,
+            user_ids=user_ids,
+            content=content,
+            file_obj=io.BytesIO(file_bytes),
+            file_size=len(file_bytes),
+            file_name=file_name,
+            on_progress=on_progress,
+            group=group
+        )
+
+    async def send_message_with_file(self, token: str, user_ids: list, content: str, file_obj: BinaryIO, file_size: int, file_name: str, on_progress=None, group: Optional[Tuple[str, str]] = None):
+        """
+        Igual que send_message_with_attachment pero leyendo el archivo de un objeto
+        tipo archivo (p.ej. el temporal de un multipart), sin cargarlo entero en memoria.
+        """
+        sender_id, message_body = await self.prepare_message_with_file(
+            token, content, file_obj, file_size, file_name, on_progress=on_progress
+        )
+
+        # 6. Enviar mensaje a cada usuario individual. Los destinatarios se aíslan:
+        #    si uno falla, los demás siguen.
+        results = await self.deliver(token, sender_id, user_ids, message_body, group=group)
+        for result in results:
+            result.pop("message", None)
+        return results
+
+    async def deliver(self, token: str, sender_id: str, user_ids: list, message_body: dict, group: Optional[Tuple[str, str]] = None):
+        """
+        Entrega un mensaje ya preparado a una lista de destinatarios (un resultado por cada uno).
+        Con group=(audience_key, topic) se publica en el chat grupal de la audiencia.
+        """
         headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
         }
-
+        modo = "oneOnOne" if group is None else "group"
+        with GRAPH_OPERATION_SECONDS.time(operation=f"deliver_{modo}"):
+            if group is not None:
+                audience_key, topic = group
+                results = await self._entregar_en_grupo(get_http_client(), headers, sender_id, user_ids, message_body, audience_key, topic)
+            else:
+                results = await self._entregar(get_http_client(), headers, sender_id, user_ids, message_body)
+        for result in results:
+            GRAPH_MESSAGES_TOTAL.inc(delivery=modo, status=result["status"])
+        return results
+
+    async def _adjunto_existente(self, client: httpx.AsyncClient, headers: dict, sender_id: str, digest: str):
+        """
+        Busca el archivo en attachment_cache y comprueba en OneDrive que siga
+        existiendo (de paso se renueva la URL de la miniatura). Si ya no existe,
+        se olvida para volver a subirlo.
+        """
+        adjunto = attachment_cache.get(sender_id, digest)
+        if adjunto is None:
+            return None
+
+        response = await client.get(
+            f"{GRAPH_BASE_URL}/me/drive/items/{adjunto['item_id']}?$select=id,webUrl&$expand=thumbnails",
+            headers=headers
+        )
+        if response.status_code in (403, 404):
+            attachment_cache.invalidate(sender_id, digest)
+            return None
+        if response.status_code != 200:
+            return None
+
+        item = response.json()
+        thumbnails = item.get("thumbnails") or []
+        if thumbnails:
+            adjunto["thumbnail_url"] = thumbnails[0].get("medium", {}).get("url") or adjunto["thumbnail_url"]
+        adjunto["web_url"] = item.get("webUrl", adjunto["web_url"])
+        attachment_cache.set(sender_id, digest, adjunto["item_id"], adjunto["web_url"], adjunto["thumbnail_url"])
+        return adjunto
+
+    async def _miniatura_con_espera(self, token: str, sender_id: str, digest: str, file_id: str, file_web_url: str):
+        """
+        Pide la miniatura en una tarea aparte y la espera un tiempo acotado. Si la
+        tarea termina después, el resultado se guarda en attachment_cache.
+        """
+        async def obtener():
+            try:
+                return await self.get_file_thumbnail(token, file_id)
+            except Exception:
+                return None
+
+        tarea = asyncio.create_task(obtener())
         try:
-            async with httpx.AsyncClient() as client:
-                # 1. Obtener el ID del usuario autenticado
-                me_response = await client.get("https://graph.microsoft.com/v1.0/me", headers=headers)
-                me_response.raise_for_status()
-                sender_id = me_response.json()["id"]
+            return await asyncio.wait_for(asyncio.shield(tarea), THUMBNAIL_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            def guardar(t: asyncio.Task):
+                if not t.cancelled() and t.result():
+                    attachment_cache.set(sender_id, digest, file_id, file_web_url, t.result())
+
+            tarea.add_done_callback(guardar)
+            return None
+
+    async def prepare_message_with_file(self, token: str, content: str, file_obj: BinaryIO, file_size: int, file_name: str, on_progress=None):
+        """
+        Sube el archivo a OneDrive y arma el mensaje con la tarjeta del adjunto.
+        Devuelve (sender_id, message_body), listos para deliver().
+        """
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        }
 
-                # 2. Crear sesión de subida para OneDrive
+        try:
+            client = get_http_client()
+            # 1. Obtener el ID del usuario autenticado
+            sender_id = (await self.get_me(token))["id"]
+
+            # 2. Si este remitente ya subió el mismo archivo (nombre y contenido), reutilizarlo.
+            #    El hash lee todo el archivo: en un hilo para no frenar el event loop
+            digest = await asyncio.to_thread(content_hash, file_obj, file_name)
+            adjunto = await self._adjunto_existente(client, headers, sender_id, digest)
+
+            if adjunto is not None:
+                file_id = adjunto["item_id"]
+                file_web_url = adjunto["web_url"]
+                file_thumbnail_url = adjunto["thumbnail_url"]
+                if on_progress:
+                    on_progress(file_size, file_size)
+            else:
+                # 3. Crear sesión de subida para OneDrive
                 upload_session = await client.post(
-                    f"https://graph.microsoft.com/v1.0/me/drive/root:/{file_name}:/createUploadSession",
+                    f"{GRAPH_BASE_URL}/me/drive/root:/{file_name}:/createUploadSession",
                     headers=headers,
                     json={"item": {"@microsoft.graph.conflictBehavior": "rename"}}
                 )
                 upload_session.raise_for_status()
                 upload_url = upload_session.json()["uploadUrl"]
 
-                # 3. Subir el archivo
-                upload_headers = {
-                    "Content-Length": str(len(file_bytes)),
-                    "Content-Range": f"bytes 0-{len(file_bytes) - 1}/{len(file_bytes)}"
-                }
-
-                upload_response = await client.put(upload_url, headers=upload_headers, content=file_bytes)
-                upload_response.raise_for_status()
-                drive_item = upload_response.json()
+                # 4. Subir el archivo por fragmentos (reanudable si falla alguno)
+                with GRAPH_OPERATION_SECONDS.time(operation="upload"):
+                    drive_item = await upload_in_chunks(
+                        client,
+                        upload_url,
+                        file_obj,
+                        file_size,
+                        on_progress=on_progress
+                    )
                 file_id = drive_item["id"]
                 file_web_url = drive_item["webUrl"]
 
-                # 4. Obtener vista previa (thumbnail)
-                file_thumbnail_url = None
-                thumbnail_response = await client.get(
-                    f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/thumbnails",
-                    headers=headers
-                )
-
-                if thumbnail_response.status_code == 200:
-                    thumbnails = thumbnail_response.json().get("value", [])
-                    if thumbnails:
-                        file_thumbnail_url = thumbnails[0].get("medium", {}).get("url")
-
-                # 5. Enviar mensaje a cada usuario individual
-                results = []
-
-                for user_id in user_ids:
-                    # Crear chat 1 a 1
-                    chat_body = {
-                        "chatType": "oneOnOne",
-                        "members": [
-                            {
-                                "@odata.type": "#microsoft.graph.aadUserConversationMember",
-                                "roles": ["owner"],
-                                "user@odata.bind": f"https://graph.microsoft.com/v1.0/users/{sender_id}"
-                            },
-                            {
-                                "@odata.type": "#microsoft.graph.aadUserConversationMember",
-                                "roles": ["owner"],
-                                "user@odata.bind": f"https://graph.microsoft.com/v1.0/users/{user_id}"
-                            }
-                        ]
-                    }
-
-                    chat_response = await client.post("https://graph.microsoft.com/v1.0/chats", headers=headers, json=chat_body)
-                    chat_response.raise_for_status()
-                    chat_id = chat_response.json()["id"]
-
-                    # Construir tarjeta Adaptive Card
-                    adaptive_card = {
-                        "type": "AdaptiveCard",
-                        "body": [
-                            {
-                                "type": "TextBlock",
-                                "text": f"📄 {file_name}",
-                                "weight": "bolder",
-                                "size": "medium",
-                                "wrap": True
-                            },
-                            {
-                                "type": "TextBlock",
-                                "text": "Aquí tienes el archivo que solicitaste. Puedes abrirlo o verlo en vista previa si está disponible.",
-                                "isSubtle": True,
-                                "wrap": True
-                            },
-                            {
-                                "type": "Image",
-                                "url": file_thumbnail_url,
-                                "size": "medium",
-                                "altText": "Vista previa del archivo"
-                            }
-                        ],
-                        "actions": [
-                            {
-                                "type": "Action.OpenUrl",
-                                "title": "📂 Abrir archivo",
-                                "url": file_web_url
-                            }
-                        ],
-                        "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-                        "version": "1.2"
+                # 5. Obtener vista previa (thumbnail) sin frenar el envío: se espera
+                #    como mucho THUMBNAIL_WAIT_SECONDS; si no llega, la tarjeta va sin imagen
+                #    y la miniatura queda guardada para la próxima vez que se mande el archivo
+                with GRAPH_OPERATION_SECONDS.time(operation="thumbnail_wait"):
+                    file_thumbnail_url = await self._miniatura_con_espera(token, sender_id, digest, file_id, file_web_url)
+
+                attachment_cache.set(sender_id, digest, file_id, file_web_url, file_thumbnail_url)
+
+            # Construir tarjeta Adaptive Card
+            card_body = [
+                {
+                    "type": "TextBlock",
+                    "text": f"📄 {file_name}",
+                    "weight": "bolder",
+                    "size": "medium",
+                    "wrap": True
+                },
+                {
+                    "type": "TextBlock",
+                    "text": "Aquí tienes el archivo que solicitaste. Puedes abrirlo o verlo en vista previa si está disponible.",
+                    "isSubtle": True,
+                    "wrap": True
+                }
+            ]
+            if file_thumbnail_url:
+                card_body.append({
+                    "type": "Image",
+                    "url": file_thumbnail_url,
+                    "size": "medium",
+                    "altText": "Vista previa del archivo"
+                })
+
+            adaptive_card = {
+                "type": "AdaptiveCard",
+                "body": card_body,
+                "actions": [
+                    {
+                        "type": "Action.OpenUrl",
+                        "title": "📂 Abrir archivo",
+                        "url": file_web_url
                     }
+                ],
+                "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+                "version": "1.2"
+            }
 
-                    # ✅ Mensaje con attachment y campo "id"
-                    message_body = {
-                        "body": {
-                            "contentType": "html",
-                            "content": f"{content}<br><attachment id=\"{file_id}\"></attachment>"  # Usar el ID del archivo subido
-                        },
-                        "attachments": [
-                            {
-                                "id": f"{file_id}",  # Asegúrate de que el ID del adjunto sea el correcto
-                                "contentType": "application/vnd.microsoft.card.adaptive",
-                                "content": json.dumps(adaptive_card)
-                            }
-                        ]
+            # ✅ Mensaje con attachment y campo "id"
+            message_body = {
+                "body": {
+                    "contentType": "html",
+                    "content": f"{content}<br><attachment id=\"{file_id}\"></attachment>"  # Usar el ID del archivo subido
+                },
+                "attachments": [
+                    {
+                        "id": f"{file_id}",  # Asegúrate de que el ID del adjunto sea el correcto
+                        "contentType": "application/vnd.microsoft.card.adaptive",
+                        "content": json.dumps(adaptive_card)
                     }
-                    message_response = await client.post(
-                        f"https://graph.microsoft.com/v1.0/chats/{chat_id}/messages",
-                        headers=headers,
-                        json=message_body
-                    )
-                    message_response.raise_for_status()
+                ]
+            }
 
-                    results.append({
-                        "user_id": user_id,
-                        "chat_id": chat_id,
-                        "message_id": message_response.json().get("id"),
-                        "status": "success"
-                    })
-                return results
+            return sender_id, message_body
 
         except httpx.HTTPStatusError as e:
             raise Exception(f"HTTP Error {e.response.status_code}: {e.response.text}")
@@ -274,25 +723,19 @@ class GraphService:
         }
     
         try:
-            async with httpx.AsyncClient() as client:
-                # Obtener la miniatura del archivo
-                thumbnail_response = await client.get(
-                    f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/thumbnails/0/medium",
-                    headers=headers
-                )
-    
-                # Verificar si la miniatura está disponible
-                thumbnail_response.raise_for_status()
-                thumbnail_data = thumbnail_response.json()
-                
-                # Obtener URL de la miniatura
-                thumbnail_url = thumbnail_data.get("link", {}).get("href", None)
+            client = get_http_client()
+            # Obtener la miniatura del archivo
+            thumbnail_response = await client.get(
+                f"{GRAPH_BASE_URL}/me/drive/items/{file_id}/thumbnails/0/medium",
+                headers=headers
+            )
     
-                if thumbnail_url:
-                    return thumbnail_url
-                else:
-                    # Si no hay miniatura, puedes usar un ícono genérico
-                    return "https://example.com/icono_pdf.png"  # Ícono genérico para archivos PDF
+            # Verificar si la miniatura está disponible
+            thumbnail_response.raise_for_status()
+            thumbnail_data = thumbnail_response.json()
+            
+            # Obtener URL de la miniatura (None si el archivo no tiene vista previa)
+            return thumbnail_data.get("url")
     
         except httpx.HTTPStatusError as e:
             raise Exception(f"Error al obtener la miniatura: {e.response.status_code}: {e.response.text}")
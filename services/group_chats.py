@@ -0,0 +1,118 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from services.directory import CARRERAS, letra_de_carrera
+
+# Archivo SQLite con los chats grupales creados por audiencia
+GROUP_CHAT_CACHE_PATH = os.getenv("GROUP_CHAT_CACHE_PATH", "group_chats.db")
+# Teams admite hasta 250 miembros por chat grupal (incluido quien envía)
+GROUP_CHAT_MAX_MEMBERS = int(os.getenv("GROUP_CHAT_MAX_MEMBERS", "250"))
+
+
+def describir_audiencia(ids: Optional[List[str]] = None, carrera: Optional[str] = None,
+                        matricula_prefix: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Clave estable y título del chat para una audiencia. Con selectores la clave es
+    la carrera/generación, así el mismo chat se reutiliza y sus miembros se sincronizan
+    cuando cambia el directorio; los ids explícitos entran como hash de la lista.
+    """
+    partes_clave = []
+    partes_titulo = ["Avisos ITSA"]
+    letra = letra_de_carrera(carrera) if carrera else None
+    if letra:
+        partes_clave.append(f"carrera={letra}")
+        partes_titulo.append(CARRERAS[letra])
+    if matricula_prefix:
+        partes_clave.append(f"matricula={matricula_prefix.strip().upper()}")
+        partes_titulo.append(f"Generación {matricula_prefix.strip()}")
+    if ids:
+        digest = hashlib.sha256(",".join(sorted(set(ids))).encode()).hexdigest()[:16]
+        partes_clave.append(f"ids={digest}")
+    return "&".join(partes_clave), " - ".join(partes_titulo)
+
+
+class GroupChatStore:
+    """
+    Chats grupales creados por (sender_id, audiencia). Una audiencia de más de
+    GROUP_CHAT_MAX_MEMBERS alumnos se reparte en varias partes, cada una con su
+    chat; de cada chat se guardan los miembros para sincronizarlos por diferencia.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS group_chats ("
+                " sender_id TEXT NOT NULL,"
+                " audience_key TEXT NOT NULL,"
+                " part INTEGER NOT NULL,"
+                " chat_id TEXT NOT NULL,"
+                " PRIMARY KEY (sender_id, audience_key, part))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS group_chat_members ("
+                " chat_id TEXT NOT NULL,"
+                " user_id TEXT NOT NULL,"
+                " PRIMARY KEY (chat_id, user_id))"
+            )
+            self._conn = conn
+        return self._conn
+
+    def get(self, sender_id: str, audience_key: str) -> Dict[int, Tuple[str, Set[str]]]:
+        """Partes de la audiencia: part -> (chat_id, miembros)"""
+        with self._lock:
+            conn = self._connection()
+            chats = conn.execute(
+                "SELECT part, chat_id FROM group_chats WHERE sender_id = ? AND audience_key = ? ORDER BY part",
+                (sender_id, audience_key)
+            ).fetchall()
+            partes = {}
+            for part, chat_id in chats:
+                filas = conn.execute(
+                    "SELECT user_id FROM group_chat_members WHERE chat_id = ?", (chat_id,)
+                ).fetchall()
+                partes[part] = (chat_id, {fila[0] for fila in filas})
+        return partes
+
+    def save(self, sender_id: str, audience_key: str, part: int, chat_id: str, members: Set[str]):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN")
+                conn.execute(
+                    "INSERT OR REPLACE INTO group_chats (sender_id, audience_key, part, chat_id) VALUES (?, ?, ?, ?)",
+                    (sender_id, audience_key, part, chat_id)
+                )
+                conn.execute("DELETE FROM group_chat_members WHERE chat_id = ?", (chat_id,))
+                conn.executemany(
+                    "INSERT INTO group_chat_members (chat_id, user_id) VALUES (?, ?)",
+                    [(chat_id, user_id) for user_id in members]
+                )
+
+    def invalidate(self, sender_id: str, audience_key: str, part: int):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN")
+                fila = conn.execute(
+                    "SELECT chat_id FROM group_chats WHERE sender_id = ? AND audience_key = ? AND part = ?",
+                    (sender_id, audience_key, part)
+                ).fetchone()
+                if fila:
+                    conn.execute("DELETE FROM group_chat_members WHERE chat_id = ?", (fila[0],))
+                conn.execute(
+                    "DELETE FROM group_chats WHERE sender_id = ? AND audience_key = ? AND part = ?",
+                    (sender_id, audience_key, part)
+                )
+
+
+group_chat_store = GroupChatStore(GROUP_CHAT_CACHE_PATH)
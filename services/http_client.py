@@ -0,0 +1,89 @@
+import asyncio
+import os
+import importlib.util
+from typing import Optional
+
+import httpx
+
+from services.throttle import GraphThrottleTransport
+
+# Configuración del cliente HTTP compartido desde variables de entorno
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP2 = os.getenv("HTTP2", "false").lower() in ("1", "true", "yes")
+# Conexiones a Graph que se abren en el arranque para que las primeras peticiones no esperen el handshake
+HTTP_WARMUP_CONNECTIONS = int(os.getenv("HTTP_WARMUP_CONNECTIONS", "4"))
+
+# URL base de Microsoft Graph (se puede apuntar a un servidor local de pruebas)
+GRAPH_BASE_URL = os.getenv("GRAPH_BASE_URL", "https://graph.microsoft.com/v1.0").rstrip("/")
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _build_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    """
+    Crea el cliente con pool de conexiones compartido por todo el proceso. Las
+    peticiones a Graph pasan por el control de ritmo y reintentos de services.throttle.
+    `transport` permite sustituir la red (p.ej. un httpx.MockTransport en pruebas).
+    """
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+    # HTTP/2 solo si el paquete "h2" está instalado (httpx[http2])
+    http2 = HTTP2 and importlib.util.find_spec("h2") is not None
+
+    if transport is None:
+        transport = httpx.AsyncHTTPTransport(limits=limits, http2=http2)
+
+    return httpx.AsyncClient(
+        transport=GraphThrottleTransport(transport, GRAPH_BASE_URL),
+        timeout=timeout
+    )
+
+
+async def start_http_client(transport: Optional[httpx.AsyncBaseTransport] = None):
+    """Abre el cliente compartido (se llama desde el lifespan de la app)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client(transport)
+    return _client
+
+
+async def close_http_client():
+    """Cierra el cliente compartido y libera las conexiones del pool"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Devuelve el cliente compartido. Si la app no pasó por el lifespan
+    (scripts, consola) se crea bajo demanda.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+
+async def warm_up_graph(connections: int = HTTP_WARMUP_CONNECTIONS):
+    """
+    Abre `connections` conexiones con Graph en paralelo y las deja en el pool. Sin
+    token Graph responde 401, que basta: lo que cuenta es el handshake TCP/TLS.
+    """
+    client = get_http_client()
+
+    async def abrir():
+        response = await client.get(f"{GRAPH_BASE_URL}/")
+        await response.aclose()
+
+    await asyncio.gather(*(abrir() for _ in range(max(1, min(connections, HTTP_MAX_KEEPALIVE_CONNECTIONS)))))
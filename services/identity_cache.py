@@ -0,0 +1,68 @@
+import hashlib
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+import jwt
+
+from services.cache_backend import SharedCache, shared_cache
+
+# TTL cuando el token no es un JWT legible (no trae "exp")
+IDENTITY_CACHE_DEFAULT_TTL = float(os.getenv("IDENTITY_CACHE_DEFAULT_TTL", "300"))
+# Margen para no usar una identidad hasta el último segundo de vida del token
+IDENTITY_CACHE_SKEW = 60
+
+
+def token_claims(token: str) -> dict:
+    """
+    Lee los claims del access token sin verificar la firma. No se usa para
+    autorizar nada: Graph sigue validando el token en cada llamada.
+    """
+    try:
+        return jwt.decode(token, options={"verify_signature": False})
+    except jwt.PyJWTError:
+        return {}
+
+
+def token_expiration(token: str) -> Optional[float]:
+    exp = token_claims(token).get("exp")
+    return float(exp) if exp is not None else None
+
+
+class IdentityCache:
+    """
+    Respuesta de GET /me indexada por el hash del token, en el backend compartido:
+    un token que ya validó un worker no se vuelve a validar en los demás.
+    """
+
+    def __init__(self, cache: SharedCache):
+        self._cache = cache
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return "me:" + hashlib.sha256(token.encode()).hexdigest()
+
+    @staticmethod
+    def _ttl(token: str) -> Optional[float]:
+        """Segundos que se puede usar la identidad; None si el token ya no da margen"""
+        exp = token_expiration(token)
+        ttl = exp - IDENTITY_CACHE_SKEW - time.time() if exp else IDENTITY_CACHE_DEFAULT_TTL
+        return ttl if ttl > 0 else None
+
+    async def get(self, token: str) -> Optional[dict]:
+        return await self._cache.get(self._key(token))
+
+    async def set(self, token: str, me: dict):
+        ttl = self._ttl(token)
+        if ttl is not None:
+            await self._cache.set(self._key(token), me, ttl)
+
+    async def get_or_load(self, token: str, loader: Callable[[], Awaitable[dict]]) -> dict:
+        """Identidad en caché o loader(); las validaciones simultáneas del mismo token se juntan en una"""
+        ttl = self._ttl(token)
+        if ttl is None:
+            return await loader()
+        return await self._cache.get_or_load(self._key(token), loader, ttl)
+
+
+identity_cache = IdentityCache(shared_cache)
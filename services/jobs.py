@@ -0,0 +1,296 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+from services.graph_service import graph_service
+
+# Archivo SQLite con los envíos en segundo plano y el estado de cada destinatario
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.db")
+# Número de workers que procesan envíos en paralelo
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))
+# Destinatarios que se envían (y se registran) en cada paso de un trabajo
+JOBS_CHUNK_SIZE = int(os.getenv("JOBS_CHUNK_SIZE", "100"))
+# Estados en los que el envío ya no usa el token guardado (al reanudarlo se guarda uno nuevo)
+STATUS_SIN_TOKEN = ("completed", "failed", "paused")
+# Estados desde los que se puede reanudar un envío
+STATUS_REANUDABLE = ("paused", "failed")
+# Un worker reclama el envío por este tiempo y lo renueva en cada paso; si el proceso
+# muere, al vencer otro worker lo retoma (se revisa cada JOBS_LEASE_SECONDS / 2)
+JOBS_LEASE_SECONDS = float(os.getenv("JOBS_LEASE_SECONDS", "300"))
+
+
+class JobStore:
+    """
+    Registro persistente de los envíos masivos. Cada destinatario guarda su
+    propio estado, así un envío interrumpido continúa con los pendientes.
+    La base guarda el access token de los envíos en curso: se crea con permisos
+    0600 y el token se borra en cuanto el envío termina, falla o se pausa.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Solo el usuario del proceso puede leerla (SQLite copia el modo a -wal y -shm)
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            os.chmod(self.path, 0o600)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " sender_id TEXT NOT NULL,"
+                " token TEXT NOT NULL,"
+                " message_body TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_recipients ("
+                " job_id TEXT NOT NULL,"
+                " position INTEGER NOT NULL,"
+                " user_id TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " chat_id TEXT,"
+                " message_id TEXT,"
+                " error TEXT,"
+                " PRIMARY KEY (job_id, position))"
+            )
+            columnas = {fila["name"] for fila in conn.execute("PRAGMA table_info(jobs)")}
+            if "owner" not in columnas:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+                conn.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+            # Tokens que quedaron de envíos terminados antes de que se borraran al terminar
+            conn.execute(
+                f"UPDATE jobs SET token = '' WHERE token != '' AND status IN ({','.join('?' for _ in STATUS_SIN_TOKEN)})",
+                STATUS_SIN_TOKEN
+            )
+            self._conn = conn
+        return self._conn
+
+    def create(self, sender_id: str, token: str, message_body: dict, user_ids: List[str]) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN")
+                conn.execute(
+                    "INSERT INTO jobs (id, sender_id, token, message_body, status, created_at, updated_at)"
+                    " VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    (job_id, sender_id, token, json.dumps(message_body), now, now)
+                )
+                conn.executemany(
+                    "INSERT INTO job_recipients (job_id, position, user_id, status) VALUES (?, ?, ?, 'pending')",
+                    [(job_id, position, user_id) for position, user_id in enumerate(user_ids)]
+                )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def set_status(self, job_id: str, status: str, error: Optional[str] = None):
+        with self._lock:
+            if status in STATUS_SIN_TOKEN:
+                self._connection().execute(
+                    "UPDATE jobs SET status = ?, error = ?, token = '', updated_at = ? WHERE id = ?",
+                    (status, error, time.time(), job_id)
+                )
+            else:
+                self._connection().execute(
+                    "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                    (status, error, time.time(), job_id)
+                )
+
+    def claim(self, job_id: str, owner: str) -> bool:
+        """
+        Marca el envío como "running" para `owner` si está en cola o si el lease de
+        otro worker venció. Es atómico: de varios workers (o procesos) solo uno gana.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._connection().execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease_until = ?, updated_at = ?"
+                " WHERE id = ? AND (status = 'queued'"
+                " OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?)))",
+                (owner, now + JOBS_LEASE_SECONDS, now, job_id, now)
+            )
+        return cursor.rowcount == 1
+
+    def renew(self, job_id: str, owner: str) -> bool:
+        """Extiende el lease; False si el envío ya no es de `owner` (venció y lo tomó otro)"""
+        with self._lock:
+            cursor = self._connection().execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                (time.time() + JOBS_LEASE_SECONDS, job_id, owner)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, owner: str):
+        """Devuelve a la cola los envíos de `owner` (al detener la app) para que otro los retome ya"""
+        with self._lock:
+            self._connection().execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, lease_until = NULL, updated_at = ?"
+                " WHERE owner = ? AND status = 'running'",
+                (time.time(), owner)
+            )
+
+    def requeue(self, job_id: str, token: str) -> bool:
+        """Vuelve a poner en cola un envío pausado o fallido con un token nuevo"""
+        with self._lock:
+            cursor = self._connection().execute(
+                "UPDATE jobs SET status = 'queued', error = NULL, token = ?, owner = NULL, lease_until = NULL,"
+                f" updated_at = ? WHERE id = ? AND status IN ({','.join('?' for _ in STATUS_REANUDABLE)})",
+                (token, time.time(), job_id, *STATUS_REANUDABLE)
+            )
+        return cursor.rowcount == 1
+
+    def pending(self, job_id: str, limit: int) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._connection().execute(
+                "SELECT position, user_id FROM job_recipients"
+                " WHERE job_id = ? AND status = 'pending' ORDER BY position LIMIT ?",
+                (job_id, limit)
+            ).fetchall()
+
+    def record_results(self, job_id: str, positions: List[int], results: List[dict]):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "UPDATE job_recipients SET status = ?, chat_id = ?, message_id = ?, error = ?"
+                    " WHERE job_id = ? AND position = ?",
+                    [
+                        (r["status"], r.get("chat_id"), r.get("message_id"), r.get("error"), job_id, position)
+                        for position, r in zip(positions, results)
+                    ]
+                )
+                conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def progress(self, job_id: str) -> dict:
+        with self._lock:
+            filas = self._connection().execute(
+                "SELECT status, COUNT(*) FROM job_recipients WHERE job_id = ? GROUP BY status",
+                (job_id,)
+            ).fetchall()
+        conteo = {status: total for status, total in filas}
+        return {
+            "total": sum(conteo.values()),
+            "sent": conteo.get("success", 0),
+            "failed": conteo.get("error", 0),
+            "pending": conteo.get("pending", 0),
+        }
+
+    def failures(self, job_id: str) -> List[dict]:
+        with self._lock:
+            filas = self._connection().execute(
+                "SELECT user_id, error FROM job_recipients WHERE job_id = ? AND status = 'error' ORDER BY position",
+                (job_id,)
+            ).fetchall()
+        return [{"user_id": fila["user_id"], "status": "error", "error": fila["error"]} for fila in filas]
+
+    def claimable(self) -> List[str]:
+        """Envíos en cola o cuyo worker dejó vencer el lease"""
+        with self._lock:
+            filas = self._connection().execute(
+                "SELECT id FROM jobs WHERE status = 'queued'"
+                " OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?)) ORDER BY created_at",
+                (time.time(),)
+            ).fetchall()
+        return [fila["id"] for fila in filas]
+
+
+class JobQueue:
+    """
+    Cola en proceso con un grupo de workers asyncio que drenan los envíos. Antes de
+    ejecutar un envío se reclama en la base (JobStore.claim): aunque el mismo id
+    quede encolado dos veces o en varios procesos de uvicorn, solo uno lo ejecuta.
+    """
+
+    def __init__(self, store: JobStore, workers: int):
+        self.store = store
+        self.workers = workers
+        self.owner = uuid.uuid4().hex
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        """Arranca los workers y la revisión periódica de envíos abandonados"""
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._retomar()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.store.release(self.owner)
+
+    async def _retomar(self):
+        """Encola los envíos pendientes: los de antes del arranque y los de workers caídos"""
+        while True:
+            for job_id in self.store.claimable():
+                self._queue.put_nowait(job_id)
+            await asyncio.sleep(JOBS_LEASE_SECONDS / 2)
+
+    def enqueue(self, job_id: str):
+        if self._queue is None:
+            raise RuntimeError("La cola de envíos no está iniciada")
+        self._queue.put_nowait(job_id)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                print(f"Error en el envío {job_id}: {e}")
+                self.store.set_status(job_id, "failed", str(e))
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str):
+        if not self.store.claim(job_id, self.owner):
+            # Ya terminó, está pausado o lo está ejecutando otro worker
+            return
+
+        job = self.store.get(job_id)
+        message_body = json.loads(job["message_body"])
+
+        while True:
+            if not self.store.renew(job_id, self.owner):
+                return
+            pendientes = self.store.pending(job_id, JOBS_CHUNK_SIZE)
+            if not pendientes:
+                break
+
+            user_ids = [fila["user_id"] for fila in pendientes]
+            results = await graph_service.deliver(job["token"], job["sender_id"], user_ids, message_body)
+
+            # Si el token venció no se marca nada: el envío queda en pausa hasta
+            # que quien lo creó lo reanude con un token nuevo
+            if all(r["status"] != "success" and r.get("error", "").startswith("HTTP Error 401") for r in results):
+                self.store.set_status(job_id, "paused", "El token de acceso venció; reanuda el envío con un token nuevo")
+                return
+
+            self.store.record_results(job_id, [fila["position"] for fila in pendientes], results)
+
+        self.store.set_status(job_id, "completed")
+
+
+job_store = JobStore(JOBS_DB_PATH)
+job_queue = JobQueue(job_store, JOBS_WORKERS)
@@ -0,0 +1,178 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+# Escribe cada petición (a la API y a Graph) como una línea JSON en la salida estándar
+METRICS_JSON_LOGS = os.getenv("METRICS_JSON_LOGS", "false").lower() in ("1", "true", "yes")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escapar(valor: str) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etiquetas(nombres: Sequence[str], valores: Tuple[str, ...], extra: str = "") -> str:
+    partes = [f'{nombre}="{_escapar(valor)}"' for nombre, valor in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+
+def _numero(valor: float) -> str:
+    return repr(float(valor)) if valor != int(valor) else str(int(valor))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._valores: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        clave = tuple(str(labels.get(nombre, "")) for nombre in self.labelnames)
+        self._valores[clave] = self._valores.get(clave, 0) + amount
+
+    def render(self) -> List[str]:
+        lineas = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for clave, valor in sorted(self._valores.items()):
+            lineas.append(f"{self.name}{_etiquetas(self.labelnames, clave)} {_numero(valor)}")
+        return lineas
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # clave de etiquetas -> [conteo por bucket..., suma, total]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        clave = tuple(str(labels.get(nombre, "")) for nombre in self.labelnames)
+        serie = self._series.get(clave)
+        if serie is None:
+            serie = self._series[clave] = [0] * (len(self.buckets) + 2)
+        for i, limite in enumerate(self.buckets):
+            if value <= limite:
+                serie[i] += 1
+        serie[-2] += value
+        serie[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Mide lo que tarda el bloque, también si termina con una excepción"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - inicio, **labels)
+
+    def render(self) -> List[str]:
+        lineas = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for clave, serie in sorted(self._series.items()):
+            for limite, conteo in zip(self.buckets, serie):
+                le = 'le="' + _numero(limite) + '"'
+                lineas.append(f"{self.name}_bucket{_etiquetas(self.labelnames, clave, le)} {conteo}")
+            le = 'le="+Inf"'
+            lineas.append(f"{self.name}_bucket{_etiquetas(self.labelnames, clave, le)} {serie[-1]}")
+            lineas.append(f"{self.name}_sum{_etiquetas(self.labelnames, clave)} {_numero(serie[-2])}")
+            lineas.append(f"{self.name}_count{_etiquetas(self.labelnames, clave)} {serie[-1]}")
+        return lineas
+
+
+# Métricas del proceso. Con varios workers cada uno expone las suyas.
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Tiempo de respuesta de la API por ruta (hasta enviar las cabeceras)",
+    ("method", "route", "status")
+)
+GRAPH_REQUEST_SECONDS = Histogram(
+    "graph_request_duration_seconds",
+    "Latencia de cada petición a Graph por operación, reintentos incluidos",
+    ("operation", "method", "status")
+)
+GRAPH_OPERATION_SECONDS = Histogram(
+    "graph_operation_duration_seconds",
+    "Duración de las operaciones de GraphService (entrega, subida, miniatura, directorio)",
+    ("operation",)
+)
+GRAPH_THROTTLED_TOTAL = Counter(
+    "graph_throttled_total",
+    "Respuestas 429/503 de Graph",
+    ("operation", "status")
+)
+GRAPH_RETRIES_TOTAL = Counter(
+    "graph_retries_total",
+    "Reintentos de peticiones a Graph",
+    ("operation", "reason")
+)
+GRAPH_UPLOAD_BYTES_TOTAL = Counter(
+    "graph_upload_bytes_total",
+    "Bytes subidos a OneDrive en sesiones de subida"
+)
+GRAPH_MESSAGES_TOTAL = Counter(
+    "graph_messages_total",
+    "Resultados de entrega por destinatario",
+    ("delivery", "status")
+)
+
+REGISTRY = (
+    HTTP_REQUEST_SECONDS,
+    GRAPH_REQUEST_SECONDS,
+    GRAPH_OPERATION_SECONDS,
+    GRAPH_THROTTLED_TOTAL,
+    GRAPH_RETRIES_TOTAL,
+    GRAPH_UPLOAD_BYTES_TOTAL,
+    GRAPH_MESSAGES_TOTAL,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render() -> str:
+    """Todas las métricas en el formato de texto de Prometheus"""
+    lineas = []
+    for metrica in REGISTRY:
+        lineas.extend(metrica.render())
+    return "\n".join(lineas) + "\n"
+
+
+def graph_operation(host: str, path: str, graph_host: str) -> str:
+    """Nombre corto de la operación de Graph para las etiquetas (/me, /chats, /users, ...)"""
+    if host != graph_host:
+        # Fuera de Graph solo salen el login y las URLs de subida de OneDrive/SharePoint
+        return "login" if host.startswith("login.") else "upload"
+
+    segmentos = [s for s in path.split("/") if s][1:]  # sin la versión ("v1.0")
+    if not segmentos:
+        return "other"
+    if segmentos[-1] == "$batch":
+        return "batch"
+    if "messages" in segmentos:
+        return "messages"
+    if "members" in segmentos:
+        return "members"
+    if "thumbnails" in segmentos:
+        return "thumbnails"
+    if any(s.endswith("createUploadSession") for s in segmentos):
+        return "upload_session"
+    if segmentos[0] == "chats":
+        return "chats"
+    if segmentos[0] == "users":
+        return "users"
+    if segmentos == ["me"]:
+        return "me"
+    if "drive" in segmentos:
+        return "drive"
+    return "other"
+
+
+def log_event(evento: str, **campos):
+    """Línea JSON con el evento, solo si METRICS_JSON_LOGS está activo"""
+    if METRICS_JSON_LOGS:
+        print(json.dumps({"ts": round(time.time(), 3), "event": evento, **campos}, ensure_ascii=False), flush=True)
@@ -0,0 +1,86 @@
+import json
+import re
+import string
+from typing import Callable, Dict, List, Optional, Union
+
+_MARCA = "\u0000"
+# Así queda la marca de un hueco una vez serializada con json.dumps
+_HUECO_RE = re.compile(r"\\u0000(\w+)\\u0000")
+
+
+def slot(nombre: str) -> str:
+    """Marca un hueco dentro de un texto del mensaje, p.ej. f"Hola {slot('displayName')}" """
+    return f"{_MARCA}{nombre}{_MARCA}"
+
+
+class MessageTemplate:
+    """
+    Cuerpo de un mensaje de chat serializado a JSON una sola vez por envío.
+    Los huecos marcados con slot() se rellenan por destinatario concatenando
+    bytes ya preparados, sin volver a recorrer ni serializar el diccionario.
+
+    Los huecos solo se admiten en textos que estén directamente en el cuerpo
+    (no dentro del "content" de una tarjeta, que ya es JSON serializado).
+    """
+
+    def __init__(self, body: dict, escape: Optional[Callable[[str], str]] = None):
+        self.escape = escape
+        texto = json.dumps(body, ensure_ascii=False)
+
+        partes = _HUECO_RE.split(texto)
+        # Posiciones pares: texto fijo; impares: nombre del hueco
+        self._literales: List[bytes] = [parte.encode() for parte in partes[0::2]]
+        self.slots: List[str] = partes[1::2]
+        self._sin_huecos = self._literales[0] if not self.slots else None
+
+    def render(self, valores: Optional[Dict[str, object]] = None) -> bytes:
+        if self._sin_huecos is not None:
+            return self._sin_huecos
+
+        valores = valores or {}
+        salida = [self._literales[0]]
+        for nombre, literal in zip(self.slots, self._literales[1:]):
+            valor = "" if valores.get(nombre) is None else str(valores[nombre])
+            if self.escape:
+                valor = self.escape(valor)
+            salida.append(json.dumps(valor, ensure_ascii=False)[1:-1].encode())
+            salida.append(literal)
+        return b"".join(salida)
+
+
+# Datos del directorio que se pueden usar en las plantillas de texto
+CAMPOS_PLANTILLA = ("displayName", "mail", "matricula", "Carrera")
+
+
+def compile_text_template(texto: str) -> MessageTemplate:
+    """
+    Compila un mensaje de texto con marcadores como "Hola {displayName} ({matricula})"
+    a un MessageTemplate. Las llaves literales se escriben dobles: {{ y }}.
+    """
+    contenido = []
+    for literal, campo, formato, conversion in string.Formatter().parse(texto):
+        contenido.append(literal)
+        if campo is None:
+            continue
+        if campo not in CAMPOS_PLANTILLA or formato or conversion:
+            raise ValueError(
+                f"Marcador no válido en la plantilla: {{{campo}}}. Disponibles: "
+                + ", ".join(f"{{{c}}}" for c in CAMPOS_PLANTILLA)
+            )
+        contenido.append(slot(campo))
+
+    return MessageTemplate({
+        "body": {
+            "contentType": "text",
+            "content": "".join(contenido)
+        }
+    })
+
+
+def serializar(body: Union[dict, bytes, MessageTemplate]) -> bytes:
+    """Cuerpo listo para enviar: los dict se serializan una vez, los bytes pasan tal cual"""
+    if isinstance(body, MessageTemplate):
+        return body.render()
+    if isinstance(body, (bytes, bytearray)):
+        return bytes(body)
+    return json.dumps(body, ensure_ascii=False).encode()
@@ -0,0 +1,67 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+# Tiempo máximo por paso de calentamiento; si se pasa, la réplica queda lista igual
+WARMUP_STEP_TIMEOUT = float(os.getenv("WARMUP_STEP_TIMEOUT", "30"))
+
+
+class Readiness:
+    """
+    Calentamiento del arranque (MSAL, conexiones, directorio) y su estado para
+    /ready. Un paso que falla no deja la réplica fuera para siempre: queda
+    "degraded" y esa parte se resuelve en la primera petición, como sin calentar.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.checks: Dict[str, dict] = {}
+        self._started_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _paso(self, nombre: str, paso: Callable[[], Awaitable[None]]):
+        inicio = time.perf_counter()
+        self.checks[nombre] = {"status": "pending"}
+        try:
+            await asyncio.wait_for(paso(), WARMUP_STEP_TIMEOUT)
+            self.checks[nombre] = {"status": "ok"}
+        except asyncio.TimeoutError:
+            self.checks[nombre] = {"status": "error", "error": f"más de {WARMUP_STEP_TIMEOUT:g}s"}
+        except Exception as e:
+            self.checks[nombre] = {"status": "error", "error": str(e) or type(e).__name__}
+            print(f"Error al calentar {nombre}: {e}")
+        self.checks[nombre]["seconds"] = round(time.perf_counter() - inicio, 3)
+
+    async def _calentar(self, pasos: Dict[str, Callable[[], Awaitable[None]]]):
+        await asyncio.gather(*(self._paso(nombre, paso) for nombre, paso in pasos.items()))
+        self.ready = True
+
+    def start(self, pasos: Dict[str, Callable[[], Awaitable[None]]]):
+        """Ejecuta los pasos en paralelo en segundo plano; /ready responde 503 mientras tanto"""
+        self.ready = False
+        self.checks = {nombre: {"status": "pending"} for nombre in pasos}
+        self._started_at = time.time()
+        self._task = asyncio.create_task(self._calentar(pasos))
+
+    async def stop(self):
+        self.ready = False
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def status(self) -> dict:
+        if not self.ready:
+            estado = "warming"
+        elif all(check["status"] == "ok" for check in self.checks.values()):
+            estado = "ready"
+        else:
+            estado = "degraded"
+        return {"status": estado, "started_at": self._started_at, "checks": self.checks}
+
+
+readiness = Readiness()
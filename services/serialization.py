@@ -0,0 +1,89 @@
+import gzip
+import json
+import os
+from typing import Any, Dict, Tuple
+
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # viene en requirements.txt; si falta se usa json de la biblioteca estándar
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # ídem: sin brotli solo se precomprime gzip
+    brotli = None
+
+# Nivel de compresión de las respuestas precomprimidas (se calculan una vez por versión)
+PRECOMPRESS_GZIP_LEVEL = int(os.getenv("PRECOMPRESS_GZIP_LEVEL", "9"))
+PRECOMPRESS_BROTLI_QUALITY = int(os.getenv("PRECOMPRESS_BROTLI_QUALITY", "9"))
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """JSON en UTF-8 con orjson si está instalado"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys).encode()
+
+
+def loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse que serializa con dumps() (orjson cuando está disponible)"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class StreamingAwareGZipMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware que deja sin comprimir las rutas de streaming (NDJSON). El gzip de
+    Starlette no vacía su búfer en cada fragmento: el cliente no recibiría nada hasta
+    juntar decenas de KB y se perdería la primera página en cuanto llega de Graph.
+    """
+
+    def __init__(self, app, exclude_paths: Tuple[str, ...] = (), **kwargs):
+        super().__init__(app, **kwargs)
+        self.exclude_paths = tuple(exclude_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.exclude_paths:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+class PrecompressedPayload:
+    """
+    Cuerpo JSON serializado y comprimido una sola vez (identity, gzip y br si hay
+    brotli). Cada petición elige la variante según Accept-Encoding y la envía tal cual.
+    """
+
+    def __init__(self, obj: Any):
+        raw = dumps(obj)
+        self.bodies: Dict[str, bytes] = {
+            "identity": raw,
+            "gzip": gzip.compress(raw, compresslevel=PRECOMPRESS_GZIP_LEVEL, mtime=0),
+        }
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(raw, quality=PRECOMPRESS_BROTLI_QUALITY)
+
+    def negotiate(self, accept_encoding: str) -> Tuple[str, bytes]:
+        """(encoding, cuerpo) para el Accept-Encoding del cliente; br > gzip > sin comprimir"""
+        aceptadas = set()
+        for parte in (accept_encoding or "").split(","):
+            nombre, _, parametros = parte.strip().partition(";")
+            if parametros.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                continue
+            aceptadas.add(nombre.strip().lower())
+
+        for encoding in ("br", "gzip"):
+            if encoding in self.bodies and (encoding in aceptadas or "*" in aceptadas):
+                return encoding, self.bodies[encoding]
+        return "identity", self.bodies["identity"]
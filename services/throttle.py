@@ -0,0 +1,267 @@
+import asyncio
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from collections import deque
+from typing import Deque, Dict, Mapping, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+from services.identity_cache import token_claims
+from services.metrics import (
+    GRAPH_REQUEST_SECONDS, GRAPH_RETRIES_TOTAL, GRAPH_THROTTLED_TOTAL, graph_operation, log_event
+)
+
+# Límites de ritmo hacia Graph (operaciones por segundo y ráfaga máxima; cada
+# sub-petición de un $batch cuenta). La cubeta del tenant cuenta todas las llamadas;
+# la del remitente solo los mensajes de chat (POST .../messages), que es lo que Teams
+# limita por usuario: crear chats, /me o los miembros no frenan a quien envía.
+# Lo que sobre lo corrige el límite adaptativo con los 429 y su Retry-After.
+GRAPH_TENANT_RATE = float(os.getenv("GRAPH_TENANT_RATE", "30"))
+GRAPH_TENANT_BURST = float(os.getenv("GRAPH_TENANT_BURST", "60"))
+GRAPH_SENDER_RATE = float(os.getenv("GRAPH_SENDER_RATE", "20"))
+GRAPH_SENDER_BURST = float(os.getenv("GRAPH_SENDER_BURST", "40"))
+# Peticiones a Graph en vuelo como máximo; baja sola cuando Graph responde 429/503
+GRAPH_MAX_IN_FLIGHT = int(os.getenv("GRAPH_MAX_IN_FLIGHT", "32"))
+# Reintentos ante 429/503/504 o errores de red, con espera exponencial y jitter
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "5"))
+GRAPH_BACKOFF_BASE = float(os.getenv("GRAPH_BACKOFF_BASE", "0.5"))
+GRAPH_BACKOFF_MAX = float(os.getenv("GRAPH_BACKOFF_MAX", "30"))
+
+RETRYABLE_STATUS = (429, 503, 504)
+THROTTLED_STATUS = (429, 503)
+# Solo GET/HEAD se reintentan tras un timeout de lectura o un 504. Un POST (mensaje,
+# chat, $batch) pudo haberse procesado igual: repetirlo duplicaría el aviso. Esos
+# solo se reintentan si la petición seguro no llegó (conexión) o si Graph la rechazó
+# por límite (429/503).
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def retryable_status(method: str, status: int) -> bool:
+    if method.upper() in IDEMPOTENT_METHODS:
+        return status in RETRYABLE_STATUS
+    return status in THROTTLED_STATUS
+
+
+def retryable_error(method: str, error: Exception) -> bool:
+    if method.upper() in IDEMPOTENT_METHODS:
+        return isinstance(error, httpx.TransportError)
+    return isinstance(error, NOT_SENT_ERRORS)
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Segundos indicados en Retry-After (número o fecha HTTP), si viene"""
+    valor = None
+    for nombre, contenido in headers.items():
+        if nombre.lower() == "retry-after":
+            valor = str(contenido).strip()
+            break
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(valor).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_message_post(method: str, path: str) -> bool:
+    """POST de un mensaje de chat (lo único que cuenta para la cubeta del remitente)"""
+    return method.upper() == "POST" and path.rstrip("/").endswith("/messages")
+
+
+def backoff(intento: int) -> float:
+    """Espera exponencial con "full jitter" para el reintento número `intento` (desde 0)"""
+    return random.uniform(0, min(GRAPH_BACKOFF_MAX, GRAPH_BACKOFF_BASE * 2 ** intento))
+
+
+class TokenBucket:
+    """
+    Cubeta de fichas: permite `rate` peticiones por segundo con ráfagas de hasta
+    `capacity`. Cada llamada reserva su ficha al momento (el saldo puede quedar
+    negativo) y espera lo que le toque, así el orden de llegada se respeta sin locks.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1):
+        self._refill()
+        self._tokens -= tokens
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+    def pause(self, seconds: float):
+        """Vacía la cubeta para que nadie envíe durante `seconds` (tras un Retry-After)"""
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class AdaptiveLimiter:
+    """
+    Límite de concurrencia que se ajusta solo (AIMD): se reduce a la mitad cuando
+    Graph limita y vuelve a crecer poco a poco mientras las respuestas son buenas.
+    """
+
+    def __init__(self, maximo: int, minimo: int = 1):
+        self.maximo = maximo
+        self.minimo = minimo
+        self.limit = float(maximo)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    async def __aenter__(self):
+        while self._in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Si ya nos habían despertado, el hueco pasa al siguiente
+                self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self._in_flight += 1
+
+    async def __aexit__(self, *exc):
+        self._in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        libres = int(self.limit) - self._in_flight
+        while libres > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                libres -= 1
+
+    def on_throttle(self):
+        # Una ráfaga de 429 cuenta como una sola señal
+        now = time.monotonic()
+        if now - self._last_decrease >= 1:
+            self.limit = max(self.minimo, self.limit / 2)
+            self._last_decrease = now
+
+    def on_success(self):
+        self.limit = min(self.maximo, self.limit + 1 / self.limit)
+        self._wake()
+
+
+class RateGovernor:
+    """Cubetas por tenant y por remitente más el límite adaptativo de concurrencia"""
+
+    def __init__(self):
+        self.limiter = AdaptiveLimiter(GRAPH_MAX_IN_FLIGHT)
+        self._tenants: Dict[str, TokenBucket] = {}
+        self._senders: Dict[str, TokenBucket] = {}
+
+    def buckets(self, authorization: Optional[str]):
+        token = (authorization or "").split(" ", 1)[-1]
+        claims = token_claims(token) if token else {}
+        tenant = claims.get("tid", "")
+        sender = claims.get("oid", token[-32:])
+
+        if tenant not in self._tenants:
+            self._tenants[tenant] = TokenBucket(GRAPH_TENANT_RATE, GRAPH_TENANT_BURST)
+        if sender not in self._senders:
+            self._senders[sender] = TokenBucket(GRAPH_SENDER_RATE, GRAPH_SENDER_BURST)
+        return self._tenants[tenant], self._senders[sender]
+
+    def throttled(self, authorization: Optional[str], seconds: Optional[float]):
+        """Graph pidió esperar: se frena la concurrencia y, si hay Retry-After, las cubetas"""
+        self.limiter.on_throttle()
+        if seconds:
+            for bucket in self.buckets(authorization):
+                bucket.pause(seconds)
+
+
+rate_governor = RateGovernor()
+
+
+class GraphThrottleTransport(httpx.AsyncBaseTransport):
+    """
+    Transporte httpx que pasa todas las peticiones a Graph por el RateGovernor:
+    respeta las cubetas y el límite de concurrencia, y reintenta 429/503 (y, en
+    GET/HEAD, 504 y errores de red) honrando Retry-After. Un $batch consume una
+    ficha del tenant por sub-petición (extensión "graph_requests") y una del
+    remitente por cada mensaje que lleva ("graph_messages"), porque Graph limita
+    cada una por separado. Las demás URLs pasan sin cambios.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, graph_base_url: str, governor: RateGovernor = rate_governor):
+        self._transport = transport
+        self._graph_host = urlparse(graph_base_url).hostname
+        self._governor = governor
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        operacion = graph_operation(request.url.host, request.url.path, self._graph_host)
+        inicio = time.perf_counter()
+        status = "error"
+        try:
+            response = await self._enviar(request, operacion)
+            status = response.status_code
+            return response
+        finally:
+            duracion = time.perf_counter() - inicio
+            GRAPH_REQUEST_SECONDS.observe(duracion, operation=operacion, method=request.method, status=status)
+            log_event("graph_request", operation=operacion, method=request.method, status=status, seconds=round(duracion, 4))
+
+    async def _enviar(self, request: httpx.Request, operacion: str) -> httpx.Response:
+        if request.url.host != self._graph_host:
+            return await self._transport.handle_async_request(request)
+
+        authorization = request.headers.get("authorization")
+        fichas = request.extensions.get("graph_requests", 1)
+        mensajes = request.extensions.get("graph_messages", int(is_message_post(request.method, request.url.path)))
+        intento = 0
+        while True:
+            tenant, sender = self._governor.buckets(authorization)
+            await tenant.acquire(fichas)
+            if mensajes:
+                await sender.acquire(mensajes)
+
+            try:
+                async with self._governor.limiter:
+                    response = await self._transport.handle_async_request(request)
+            except httpx.TransportError as e:
+                if intento >= GRAPH_MAX_RETRIES or not retryable_error(request.method, e):
+                    raise
+                GRAPH_RETRIES_TOTAL.inc(operation=operacion, reason="network")
+                await asyncio.sleep(backoff(intento))
+                intento += 1
+                continue
+
+            if response.status_code in THROTTLED_STATUS:
+                GRAPH_THROTTLED_TOTAL.inc(operation=operacion, status=response.status_code)
+            if not retryable_status(request.method, response.status_code) or intento >= GRAPH_MAX_RETRIES:
+                if response.status_code not in THROTTLED_STATUS:
+                    self._governor.limiter.on_success()
+                return response
+
+            espera = retry_after(response.headers)
+            if response.status_code in THROTTLED_STATUS:
+                self._governor.throttled(authorization, espera)
+            GRAPH_RETRIES_TOTAL.inc(operation=operacion, reason=response.status_code)
+            await response.aclose()
+            await asyncio.sleep(espera if espera is not None else backoff(intento))
+            intento += 1
+
+    async def aclose(self):
+        await self._transport.aclose()
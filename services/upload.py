@@ -0,0 +1,103 @@
+import asyncio
+import os
+import random
+from typing import BinaryIO, Callable, Optional
+
+import httpx
+
+from services.metrics import GRAPH_RETRIES_TOTAL, GRAPH_UPLOAD_BYTES_TOTAL
+
+# Graph exige que cada fragmento (salvo el último) sea múltiplo de 320 KiB
+UPLOAD_CHUNK_UNIT = 320 * 1024
+# Tamaño de fragmento configurable; se ajusta al múltiplo de 320 KiB más cercano por debajo
+UPLOAD_CHUNK_SIZE = max(
+    UPLOAD_CHUNK_UNIT,
+    int(os.getenv("GRAPH_UPLOAD_CHUNK_SIZE", str(10 * UPLOAD_CHUNK_UNIT))) // UPLOAD_CHUNK_UNIT * UPLOAD_CHUNK_UNIT
+)
+# Reintentos seguidos permitidos para un mismo fragmento antes de abandonar la subida
+UPLOAD_MAX_RETRIES = int(os.getenv("GRAPH_UPLOAD_MAX_RETRIES", "5"))
+
+
+def _siguiente_offset(data: dict, por_defecto: int) -> int:
+    """Primer byte que espera Graph según "nextExpectedRanges" (p.ej. ["26214400-"])"""
+    rangos = data.get("nextExpectedRanges") or []
+    if not rangos:
+        return por_defecto
+    return int(str(rangos[0]).split("-")[0])
+
+
+async def _consultar_offset(client: httpx.AsyncClient, upload_url: str, por_defecto: int) -> int:
+    """Pregunta a la sesión de subida desde qué byte hay que continuar"""
+    response = await client.get(upload_url)
+    response.raise_for_status()
+    return _siguiente_offset(response.json(), por_defecto)
+
+
+async def upload_in_chunks(
+    client: httpx.AsyncClient,
+    upload_url: str,
+    source: BinaryIO,
+    size: int,
+    chunk_size: int = UPLOAD_CHUNK_SIZE,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> dict:
+    """
+    Sube el contenido de "source" a una sesión de createUploadSession por
+    fragmentos, uno detrás de otro, leyendo solo un fragmento a la vez.
+    Si un fragmento falla se consulta "nextExpectedRanges" y se reanuda desde
+    ahí. Devuelve el driveItem creado.
+
+    La URL de subida ya viene autenticada: no se manda el token de Graph.
+    """
+    if size <= 0:
+        raise ValueError("El archivo está vacío")
+    if chunk_size % UPLOAD_CHUNK_UNIT:
+        raise ValueError("El tamaño de fragmento debe ser múltiplo de 320 KiB")
+
+    offset = 0
+    intentos = 0
+
+    while True:
+        source.seek(offset)
+        chunk = source.read(min(chunk_size, size - offset))
+        fin = offset + len(chunk) - 1
+
+        try:
+            response = await client.put(
+                upload_url,
+                headers={
+                    "Content-Length": str(len(chunk)),
+                    "Content-Range": f"bytes {offset}-{fin}/{size}"
+                },
+                content=chunk
+            )
+
+            if response.status_code in (200, 201, 202):
+                GRAPH_UPLOAD_BYTES_TOTAL.inc(len(chunk))
+
+            if response.status_code in (200, 201):
+                # Último fragmento: Graph devuelve el driveItem
+                if on_progress:
+                    on_progress(size, size)
+                return response.json()
+
+            if response.status_code == 202:
+                offset = _siguiente_offset(response.json(), fin + 1)
+                intentos = 0
+                if on_progress:
+                    on_progress(offset, size)
+                continue
+
+            if response.status_code < 500 and response.status_code not in (408, 416, 429):
+                # Error definitivo (sesión caducada, permisos...): no tiene sentido reintentar
+                response.raise_for_status()
+        except httpx.TransportError:
+            pass
+
+        # Fallo transitorio: esperar y reanudar desde donde diga la sesión
+        intentos += 1
+        if intentos > UPLOAD_MAX_RETRIES:
+            raise Exception(f"No se pudo subir el archivo después de {UPLOAD_MAX_RETRIES} reintentos")
+        GRAPH_RETRIES_TOTAL.inc(operation="upload", reason="chunk")
+        await asyncio.sleep(min(30, 2 ** intentos) * random.uniform(0.5, 1))
+        offset = await _consultar_offset(client, upload_url, offset)